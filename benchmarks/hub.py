@@ -0,0 +1,320 @@
+"""Measure the hub operations as the number of servers and environments grows.
+
+Environment servers are started by a fake container backend, instantly and in the
+benchmark process, and a stub nginx is put first in the PATH, so that only the work
+of the hub is measured. The results can be saved and compared to a previous run,
+in which case a regression makes the benchmark fail.
+
+    python benchmarks/hub.py --sizes 10 100 1000 10000 --output results.json
+    python benchmarks/hub.py --baseline results.json --tolerance 1.5
+"""
+
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timezone
+from pathlib import Path
+from signal import Signals
+from typing import Annotated, Any
+
+import anyio
+import httpx
+import structlog
+from anyio import CancelScope
+from anyio.abc import Process, SocketStream, TaskGroup
+from cyclopts import App, Parameter
+
+from macroverse.config import Config
+from macroverse.containers import process
+from macroverse.containers.base import Container, ExternalProcess
+from macroverse.hub import Hub
+from macroverse.server import Server
+from macroverse.utils import Routing, get_http_client, process_routes
+from routing import ROUTES
+
+# results below this are too noisy to be compared
+MIN_COMPARED_TIME = 0.002
+ROUTES_RESPONSE = json.dumps(ROUTES).encode()
+
+app = App()
+
+
+class FakeProcess(ExternalProcess):
+    # an environment server served by the benchmark itself
+    def __init__(self) -> None:
+        super().__init__()
+        self.cancel_scope = CancelScope()
+
+    async def serve(self, port: int) -> None:
+        try:
+            with self.cancel_scope:
+                listener = await anyio.create_tcp_listener(
+                    local_host="127.0.0.1", local_port=port
+                )
+                await listener.serve(handle_routes)
+        finally:
+            self.set_returncode(0)
+
+    def send_signal(self, signal: Signals) -> None:
+        self.cancel_scope.cancel()
+
+
+async def handle_routes(stream: SocketStream) -> None:
+    async with stream:
+        await stream.receive()
+        await stream.send(
+            b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+            + f"Content-Length: {len(ROUTES_RESPONSE)}\r\n".encode()
+            + b"Connection: close\r\n\r\n"
+            + ROUTES_RESPONSE
+        )
+
+
+class FakeContainer(process.Container):
+    # set by the benchmark, the environment servers run in it
+    task_group: TaskGroup
+
+    async def create_environment(self, config: Config, lock: str | None = None) -> None:
+        assert self.path is not None
+        await anyio.Path(self.path).mkdir(parents=True, exist_ok=True)
+        await self._write_definition()
+
+    async def clone_environment(self, source: Container) -> None:
+        await self.create_environment(Config())
+
+    def get_server_command(
+        self, port: int, config: Config, socket: str | None = None
+    ) -> list[str]:
+        return []
+
+    async def start_server(
+        self, port: int, config: Config, socket: str | None = None
+    ) -> Process:
+        fake_process = FakeProcess()
+        self.task_group.start_soon(fake_process.serve, port)
+        return fake_process
+
+    async def stop_server(self, process: Process) -> None:
+        process.terminate()
+        await process.wait()
+
+    async def kill_server(self, process: Process) -> None:
+        process.kill()
+        await process.wait()
+
+
+def install_stub_nginx(bin_dir: Path) -> None:
+    nginx = bin_dir / "nginx"
+    nginx.write_text("#!/bin/sh\nexit 0\n")
+    nginx.chmod(0o755)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+
+
+async def time_it(func: Callable[[int], Awaitable[Any]], repeat: int) -> float:
+    # the median time, the function is given the repetition number
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        await func(i)
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times)
+
+
+class FakeHub(Hub):
+    async def _get_routes(
+        self, process: Process, port: int, socket: str | None, host: str | None
+    ) -> list[dict[str, Any]]:
+        # the fake servers are ready at once, so that only the hub's work is measured
+        # and not the interval between its requests for the routes
+        async with get_http_client(socket) as client:
+            while True:
+                try:
+                    response = await client.get(f"http://127.0.0.1:{port}/routes")
+                except httpx.TransportError:
+                    # the fake server is not listening yet
+                    await anyio.sleep(0)
+                    continue
+
+                return response.json()
+
+
+async def start_hub(task_group: TaskGroup, prefix: Path, config: Config) -> Hub:
+    hub = FakeHub(task_group, 8000, 8001, "process", config)
+    hub.Container = FakeContainer
+    hub.nginx_conf_path = anyio.Path(prefix / "default-site.conf")
+    hub.nginx_include_dir = anyio.Path(prefix / "macroverse")
+    hub.static_dir = anyio.Path(prefix / "static")
+    while not await hub.nginx_conf_path.exists():
+        await anyio.sleep(0.01)
+    # the background tasks are started right after
+    await anyio.sleep(0.1)
+    return hub
+
+
+async def measure(size: int, repeat: int, routing: Routing) -> dict[str, float]:
+    results = {}
+    config = Config(nginx_reload_delay=0, nginx_routing=routing)
+    with tempfile.TemporaryDirectory() as tmp:
+        prefix = Path(tmp)
+        os.chdir(prefix)
+        async with anyio.create_task_group() as tg:
+            FakeContainer.task_group = tg
+            hub = await start_hub(tg, prefix, config)
+
+            # as many servers as environments, each server has one environment
+            for i in range(size):
+                env_name = f"env{i}"
+                hub.containers[env_name] = FakeContainer(
+                    path=anyio.Path("environments") / env_name,
+                    definition={"name": env_name, "dependencies": ["python"]},
+                    routes=ROUTES,
+                )
+                hub.update_environment_nginx_conf(env_name)
+            for i in range(size):
+                server = Server(macroverse_port=hub.macroverse_port, routing=routing)
+                server.environments.add(f"env{i}")
+                hub.servers[server.id] = server
+                hub.update_server_nginx_conf(server.id)
+            servers = list(hub.servers)
+
+            async def write_all(i: int) -> None:
+                hub.dirty_servers.update(hub.servers)
+                hub.dirty_environments.update(hub.containers)
+                await hub.write_nginx_conf()
+
+            results["write_nginx_conf (all)"] = await time_it(write_all, 1)
+
+            async def write_one(i: int) -> None:
+                hub.update_server_nginx_conf(servers[i % size])
+                await hub.write_nginx_conf()
+
+            results["write_nginx_conf"] = await time_it(write_one, repeat)
+
+            async def create_server(i: int) -> None:
+                await hub.create_server()
+
+            results["create_server"] = await time_it(create_server, repeat)
+            new_servers = [uuid for uuid in hub.servers if uuid not in servers]
+
+            async def add_server_environment(i: int) -> None:
+                # a different environment every time, so that its server starts
+                await hub.add_server_environment(new_servers[i], f"env{i}")
+
+            results["add_server_environment"] = await time_it(
+                add_server_environment, min(repeat, size)
+            )
+
+            # a server with all the environments
+            server = Server(macroverse_port=hub.macroverse_port, routing=routing)
+            server.environments.update(hub.containers)
+
+            async def create_nginx_conf(i: int) -> None:
+                server.create_nginx_conf(hub.containers)
+
+            results["Server.create_nginx_conf"] = await time_it(create_nginx_conf, 1)
+
+            async def process_all_routes(i: int) -> None:
+                # for all the environments
+                for container in hub.containers.values():
+                    process_routes(
+                        ROUTES, container.upstream, str(container.id), routing
+                    )
+
+            results["process_routes"] = await time_it(process_all_routes, 1)
+
+            await hub.stop()
+            tg.cancel_scope.cancel()
+    return results
+
+
+def compare(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, dict[str, float]],
+    tolerance: float,
+) -> list[str]:
+    regressions = []
+    for name, sizes in results.items():
+        for size, result in sizes.items():
+            previous = baseline.get(name, {}).get(size)
+            if previous is None or max(result, previous) < MIN_COMPARED_TIME:
+                continue
+
+            if result > previous * tolerance:
+                regressions.append(
+                    f"{name} at {size}: {result * 1e3:.3f} ms, "
+                    f"was {previous * 1e3:.3f} ms ({result / previous:.2f}x)"
+                )
+    return regressions
+
+
+async def run(sizes: tuple[int, ...], repeat: int, routing: Routing) -> dict[str, Any]:
+    results: dict[str, dict[str, float]] = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as bin_dir:
+        install_stub_nginx(Path(bin_dir))
+        try:
+            for size in sizes:
+                for name, result in (await measure(size, repeat, routing)).items():
+                    results.setdefault(name, {})[str(size)] = result
+                    print(f"{name:>26} {size:>6}: {result * 1e3:10.3f} ms")
+        finally:
+            os.chdir(cwd)
+    return {
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "routing": routing,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+@app.default
+def main(
+    sizes: Annotated[tuple[int, ...], Parameter(consume_multiple=True)] = (
+        10,
+        100,
+        1000,
+        10000,
+    ),
+    repeat: int = 20,
+    routing: Routing = "prefix",
+    output: Path | None = None,
+    baseline: Path | None = None,
+    tolerance: float = 1.5,
+) -> int:
+    """Measure the hub operations.
+
+    Args:
+        sizes: The numbers of servers and environments.
+        repeat: The number of times the operations on a single server are measured.
+        routing: The NGINX routing mode.
+        output: The JSON file to save the results to.
+        baseline: The JSON file of a previous run to compare the results to.
+        tolerance: How many times slower than the baseline is a regression.
+    """
+    # the hub logs every operation
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(40),
+    )
+    report = anyio.run(run, sizes, repeat, routing)
+    if output is not None:
+        output.write_text(json.dumps(report, indent=2))
+    if baseline is None:
+        return 0
+
+    regressions = compare(
+        report["results"], json.loads(baseline.read_text())["results"], tolerance
+    )
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(app())
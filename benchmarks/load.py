@@ -0,0 +1,443 @@
+"""Load macroverse with the traffic of many users, through the generated NGINX configuration.
+
+The hub runs with stub jupyverse servers (the main one and one per environment),
+behind nginx with the configuration the hub writes. Users open lab pages with their
+assets, fetch contents and keep a kernel WebSocket busy, while the hub changes the
+configuration and reloads nginx in parallel. The latency of the requests, the
+WebSocket message throughput and the connections dropped are reported.
+
+    python benchmarks/load.py --servers 10 --users 100 --duration 30
+
+nginx must be installed.
+"""
+
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+import anyio
+import httpx
+import structlog
+from anycorn import Config as AnycornConfig
+from anycorn import serve
+from anyio import EndOfStream, open_process
+from anyio.abc import ByteStream, TaskGroup
+from cyclopts import App
+from wsproto import ConnectionType, WSConnection
+from wsproto.events import (
+    AcceptConnection,
+    CloseConnection,
+    Message,
+    Ping,
+    RejectConnection,
+    Request,
+)
+
+from macroverse.config import Config
+from macroverse.containers import process
+from macroverse.containers.base import Container
+from macroverse.hub import Hub
+from macroverse.utils import get_unused_tcp_ports
+from routing import NGINX_MAIN_CONF, ROUTES
+
+# what the stub servers answer
+LAB_PAGE = (
+    "<!doctype html><html><head>"
+    + "".join(f'<script src="/static/lab/{i}.{i:016x}.js"></script>' for i in range(3))
+    + "</head><body>"
+    + "<div></div>" * 1000
+    + "</body></html>"
+).encode()
+STATIC_ASSET = b"console.log(0);\n" * 16384
+CONTENTS = json.dumps(
+    {
+        "name": "notebook.ipynb",
+        "type": "notebook",
+        "content": {"cells": [{"source": "print(0)\n" * 10}] * 50},
+    }
+).encode()
+ROUTES_RESPONSE = json.dumps(ROUTES).encode()
+# dropped connections are attributed to a reload that ended this recently
+RELOAD_GRACE = 1.0
+
+app = App()
+
+
+async def stub_app(scope: dict[str, Any], receive: Any, send: Any) -> None:
+    # a jupyverse server, for any route
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            await send({"type": f"{message['type']}.complete"})
+            if message["type"] == "lifespan.shutdown":
+                return
+
+    if scope["type"] == "websocket":
+        # kernel messages are echoed
+        await receive()
+        await send({"type": "websocket.accept"})
+        while True:
+            message = await receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            await send({"type": "websocket.send", "text": message.get("text")})
+
+    path = scope["path"]
+    if path == "/routes":
+        body, content_type = ROUTES_RESPONSE, "application/json"
+    elif "/static/" in path:
+        body, content_type = STATIC_ASSET, "application/javascript"
+    elif "/api/contents" in path:
+        body, content_type = CONTENTS, "application/json"
+    else:
+        body, content_type = LAB_PAGE, "text/html"
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", content_type.encode()),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+class StubContainer(process.Container):
+    # the environment servers are stub servers, environments are just directories
+    async def create_environment(self, config: Config, lock: str | None = None) -> None:
+        assert self.path is not None
+        await anyio.Path(self.path).mkdir(parents=True, exist_ok=True)
+        await self._write_definition()
+
+    async def clone_environment(self, source: Container) -> None:
+        await self.create_environment(Config())
+
+    async def _load_activation(self) -> dict[str, str]:
+        return {}
+
+    def get_server_command(
+        self, port: int, config: Config, socket: str | None = None
+    ) -> list[str]:
+        return get_stub_server_command(port)
+
+
+def get_stub_server_command(port: int) -> list[str]:
+    return [sys.executable, __file__, "stub-server", "--port", str(port)]
+
+
+class WebSocket:
+    # a minimal client, over a TCP stream
+    def __init__(self, stream: ByteStream) -> None:
+        self.stream = stream
+        self.connection = WSConnection(ConnectionType.CLIENT)
+        self.text: list[str] = []
+
+    @classmethod
+    async def connect(cls, port: int, path: str) -> "WebSocket":
+        websocket = cls(await anyio.connect_tcp("127.0.0.1", port))
+        try:
+            await websocket.stream.send(
+                websocket.connection.send(Request(host="localhost", target=path))
+            )
+            event = await websocket._next_event()
+            if not isinstance(event, AcceptConnection):
+                raise ConnectionError(f"WebSocket rejected: {event}")
+        except BaseException:
+            await websocket.stream.aclose()
+            raise
+        return websocket
+
+    async def _next_event(self) -> Any:
+        while True:
+            for event in self.connection.events():
+                return event
+            # the server closing the connection raises EndOfStream
+            self.connection.receive_data(await self.stream.receive())
+
+    async def send(self, text: str) -> None:
+        await self.stream.send(self.connection.send(Message(data=text)))
+
+    async def receive(self) -> str:
+        while True:
+            event = await self._next_event()
+            if isinstance(event, Message):
+                self.text.append(event.data)
+                if event.message_finished:
+                    text = "".join(self.text)
+                    self.text = []
+                    return text
+            elif isinstance(event, Ping):
+                await self.stream.send(self.connection.send(event.response()))
+            elif isinstance(event, (CloseConnection, RejectConnection)):
+                raise EndOfStream
+
+    async def aclose(self) -> None:
+        await self.stream.aclose()
+
+
+@dataclass
+class Stats:
+    latencies: dict[str, list[float]] = field(default_factory=dict)
+    errors: int = 0
+    messages: int = 0
+    message_latencies: list[float] = field(default_factory=list)
+    # the time of every dropped connection and of every reload (start and end)
+    drops: list[float] = field(default_factory=list)
+    reloads: list[tuple[float, float]] = field(default_factory=list)
+
+    def add_latency(self, name: str, latency: float) -> None:
+        self.latencies.setdefault(name, []).append(latency)
+
+    def drops_during_reloads(self) -> int:
+        return sum(
+            any(start <= drop <= end + RELOAD_GRACE for start, end in self.reloads)
+            for drop in self.drops
+        )
+
+
+def format_latencies(latencies: list[float]) -> str:
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies) * 1e3
+    p99 = latencies[int(len(latencies) * 0.99)] * 1e3
+    return f"p50 {p50:8.3f} ms, p99 {p99:8.3f} ms"
+
+
+async def browse(
+    client: httpx.AsyncClient, uuid: str, stats: Stats, deadline: float
+) -> None:
+    # open the lab page with its assets, then the contents
+    requests = [("lab", f"/jupyverse/{uuid}/lab")]
+    requests += [
+        ("static", f"/jupyverse/{uuid}/static/lab/{i}.{i:016x}.js") for i in range(3)
+    ]
+    requests += [("contents", f"/jupyverse/{uuid}/api/contents/notebook.ipynb")] * 5
+    while time.monotonic() < deadline:
+        for name, url in requests:
+            t0 = time.perf_counter()
+            try:
+                response = await client.get(url)
+                response.raise_for_status()
+            except httpx.TransportError:
+                stats.errors += 1
+                stats.drops.append(time.monotonic())
+            except httpx.HTTPStatusError:
+                stats.errors += 1
+            else:
+                stats.add_latency(name, time.perf_counter() - t0)
+        # the user reads
+        await anyio.sleep(0.1)
+
+
+async def use_kernel(
+    nginx_port: int, uuid: str, stats: Stats, deadline: float, message: str
+) -> None:
+    # a kernel that keeps sending outputs, reconnected when the connection drops
+    path = f"/jupyverse/{uuid}/api/kernels/{os.urandom(8).hex()}/channels"
+    while time.monotonic() < deadline:
+        try:
+            websocket = await WebSocket.connect(nginx_port, path)
+        except (OSError, ConnectionError, EndOfStream):
+            stats.errors += 1
+            await anyio.sleep(0.1)
+            continue
+
+        try:
+            while time.monotonic() < deadline:
+                t0 = time.perf_counter()
+                await websocket.send(message)
+                await websocket.receive()
+                stats.message_latencies.append(time.perf_counter() - t0)
+                stats.messages += 1
+        except (OSError, EndOfStream, anyio.BrokenResourceError):
+            stats.drops.append(time.monotonic())
+        finally:
+            await websocket.aclose()
+
+
+async def reload_nginx(
+    hub: Hub, stats: Stats, deadline: float, interval: float
+) -> None:
+    # servers come and go, which changes the configuration
+    while time.monotonic() < deadline:
+        await anyio.sleep(interval)
+        start = time.monotonic()
+        await hub.create_server()
+        stats.reloads.append((start, time.monotonic()))
+        uuid = next(reversed(hub.servers))
+        start = time.monotonic()
+        await hub.stop_server(uuid)
+        stats.reloads.append((start, time.monotonic()))
+
+
+def install_nginx_wrapper(bin_dir: Path, prefix: Path) -> None:
+    # the hub runs "nginx", with the configuration of the prefix
+    nginx = shutil.which("nginx")
+    wrapper = bin_dir / "nginx"
+    wrapper.write_text(f'#!/bin/sh\nexec {nginx} -p {prefix} -c nginx.conf "$@"\n')
+    wrapper.chmod(0o755)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+
+
+async def start_hub(
+    task_group: TaskGroup, prefix: Path, nginx_port: int, macroverse_port: int
+) -> Hub:
+    hub = Hub(task_group, nginx_port, macroverse_port, "process", Config())
+    hub.Container = StubContainer
+    hub.nginx_conf_path = anyio.Path(prefix / "default-site.conf")
+    hub.nginx_include_dir = anyio.Path(prefix / "macroverse")
+    hub.static_dir = anyio.Path(prefix / "static")
+    hub.nginx_cache_dir = anyio.Path(prefix / "cache")
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(f"http://127.0.0.1:{nginx_port}/")
+                break
+            except httpx.TransportError:
+                await anyio.sleep(0.1)
+    return hub
+
+
+async def wait_for_stub_server(port: int) -> None:
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(f"http://127.0.0.1:{port}/routes")
+                return
+            except httpx.TransportError:
+                await anyio.sleep(0.1)
+
+
+async def run(
+    servers: int,
+    users: int,
+    duration: float,
+    reload_interval: float,
+    message_size: int,
+) -> None:
+    nginx_port, macroverse_port = get_unused_tcp_ports(2)
+    stats = Stats()
+    with tempfile.TemporaryDirectory() as tmp:
+        prefix = Path(tmp)
+        (prefix / "nginx.conf").write_text(NGINX_MAIN_CONF.format(prefix=prefix))
+        install_nginx_wrapper(prefix, prefix)
+        os.chdir(prefix)
+        # the main jupyverse server, which serves the lab pages
+        main_server = await open_process(
+            get_stub_server_command(macroverse_port), stdout=None, stderr=None
+        )
+        try:
+            await wait_for_stub_server(macroverse_port)
+            async with anyio.create_task_group() as tg:
+                hub = await start_hub(tg, prefix, nginx_port, macroverse_port)
+                print(f"Creating {servers} servers with one environment each")
+                for i in range(servers):
+                    await hub.create_environment(
+                        f"name: env{i}\ndependencies: [python]"
+                    )
+                while any(
+                    container.create_time is not None
+                    for container in hub.containers.values()
+                ):
+                    await anyio.sleep(0.1)
+                for i in range(servers):
+                    await hub.create_server()
+                uuids = list(hub.servers)
+                async with anyio.create_task_group() as server_tg:
+                    for i, uuid in enumerate(uuids):
+                        server_tg.start_soon(
+                            hub.add_server_environment, uuid, f"env{i}"
+                        )
+
+                print(f"{users} users for {duration} s")
+                deadline = time.monotonic() + duration
+                message = "x" * message_size
+                limits = httpx.Limits(max_connections=None)
+                async with (
+                    httpx.AsyncClient(
+                        base_url=f"http://127.0.0.1:{nginx_port}",
+                        limits=limits,
+                        timeout=30,
+                    ) as client,
+                    anyio.create_task_group() as users_tg,
+                ):
+                    users_tg.start_soon(
+                        reload_nginx, hub, stats, deadline, reload_interval
+                    )
+                    for i in range(users):
+                        uuid = uuids[i % len(uuids)]
+                        users_tg.start_soon(browse, client, uuid, stats, deadline)
+                        users_tg.start_soon(
+                            use_kernel, nginx_port, uuid, stats, deadline, message
+                        )
+
+                await hub.stop()
+                tg.cancel_scope.cancel()
+        finally:
+            main_server.terminate()
+            await main_server.wait()
+
+    requests = sum(len(latencies) for latencies in stats.latencies.values())
+    print(f"requests: {requests} ({stats.errors} errors)")
+    for name, latencies in stats.latencies.items():
+        print(f"{name:>10}: {len(latencies):8} requests, {format_latencies(latencies)}")
+    print(
+        f"WebSocket: {stats.messages} messages, {stats.messages / duration:.0f} msg/s"
+    )
+    if stats.message_latencies:
+        print(f"{'round-trip':>10}: {format_latencies(stats.message_latencies)}")
+    print(
+        f"nginx reloads: {len(stats.reloads)}, connections dropped: "
+        f"{len(stats.drops)} ({stats.drops_during_reloads()} during reloads)"
+    )
+
+
+@app.default
+def main(
+    servers: int = 10,
+    users: int = 100,
+    duration: float = 30,
+    reload_interval: float = 1,
+    message_size: int = 1024,
+) -> None:
+    """Load macroverse through nginx.
+
+    Args:
+        servers: The number of servers, each with one environment.
+        users: The number of concurrent users, spread over the servers.
+        duration: The duration of the load, in seconds.
+        reload_interval: The time between configuration changes, in seconds.
+        message_size: The size of the kernel messages, in bytes.
+    """
+    if shutil.which("nginx") is None:
+        sys.exit("nginx not found")
+    # the hub logs every operation
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(40),
+    )
+    anyio.run(run, servers, users, duration, reload_interval, message_size)
+
+
+@app.command
+def stub_server(port: int) -> None:
+    """Run a stub jupyverse server.
+
+    Args:
+        port: The port to listen on.
+    """
+    config = AnycornConfig()
+    config.bind = [f"127.0.0.1:{port}"]
+    config.errorlog = None
+    anyio.run(serve, stub_app, config)
+
+
+if __name__ == "__main__":
+    sys.exit(app())
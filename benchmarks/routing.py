@@ -0,0 +1,206 @@
+"""Compare the NGINX configuration produced by the "regex" and "prefix" routing modes.
+
+The configuration size is always reported. If nginx is installed, it is also run
+with the generated configuration in front of a stub environment server, and the
+latency of requests to environment routes is measured.
+
+    python benchmarks/routing.py --servers 100 --environments 5
+"""
+
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import anyio
+import httpx
+from anyio import open_process
+from anyio.abc import SocketStream
+from cyclopts import App
+
+from macroverse.containers.base import Container as BaseContainer
+from macroverse.containers.process import Container
+from macroverse.hub import NGINX_CONF
+from macroverse.server import Server
+from macroverse.utils import (
+    Routing,
+    get_unused_tcp_ports,
+    process_prefix,
+    process_routes,
+    process_upstream,
+)
+
+# the routes that jupyverse reports for an environment server with kernels and terminals
+ROUTES = [
+    {"path": "/api/kernelspecs", "methods": ["GET"]},
+    {"path": "/kernelspecs/{kernel_name}/{file_name}", "methods": ["GET"]},
+    {"path": "/api/kernels", "methods": ["GET", "POST"]},
+    {"path": "/api/kernels/{kernel_id}", "methods": ["GET", "DELETE"]},
+    {"path": "/api/kernels/{kernel_id}/interrupt", "methods": ["POST"]},
+    {"path": "/api/kernels/{kernel_id}/restart", "methods": ["POST"]},
+    {"path": "/api/kernels/{kernel_id}/channels", "methods": ["WEBSOCKET"]},
+    {"path": "/api/sessions", "methods": ["GET", "POST"]},
+    {"path": "/api/sessions/{session_id}", "methods": ["GET", "PATCH", "DELETE"]},
+    {"path": "/api/terminals", "methods": ["GET", "POST"]},
+    {"path": "/api/terminals/{name}", "methods": ["DELETE"]},
+    {"path": "/terminals/websocket/{name}", "methods": ["WEBSOCKET"]},
+]
+
+NGINX_MAIN_CONF = """\
+daemon off;
+worker_processes 1;
+pid {prefix}/nginx.pid;
+error_log {prefix}/error.log;
+
+events {{
+    worker_connections 1024;
+}}
+
+http {{
+    access_log off;
+    client_body_temp_path {prefix}/client_body;
+    proxy_temp_path {prefix}/proxy;
+    fastcgi_temp_path {prefix}/fastcgi;
+    uwsgi_temp_path {prefix}/uwsgi;
+    scgi_temp_path {prefix}/scgi;
+    include {prefix}/default-site.conf;
+}}
+"""
+
+app = App()
+
+
+def write_conf(
+    prefix: Path,
+    routing: Routing,
+    servers: int,
+    environments: int,
+    nginx_port: int,
+    environment_server_port: int,
+) -> tuple[int, int, list[str]]:
+    include_dir = prefix / "macroverse"
+    include_dir.mkdir(parents=True)
+    containers: dict[str, BaseContainer] = {
+        f"env{i}": Container(port=environment_server_port, routes=ROUTES)
+        for i in range(environments)
+    }
+    urls = []
+    for _ in range(servers):
+        server = Server(macroverse_port=environment_server_port, routing=routing)
+        server.environments.update(containers)
+        server.create_nginx_conf(containers)
+        (include_dir / f"server-{server.id}.conf").write_text(server.nginx_conf)
+        urls.append(f"/jupyverse/{server.id}/api/sessions")
+    for env_name, container in containers.items():
+        if routing == "prefix":
+            nginx_conf = process_prefix(container.upstream, str(container.id))
+        else:
+            nginx_conf = process_routes(ROUTES, container.upstream, str(container.id))
+        (include_dir / f"environment-{env_name}.conf").write_text(nginx_conf)
+    # all the environments share the stub server
+    (include_dir / "environments.upstream").write_text(
+        process_upstream(environment_server_port, keepalive=16)
+    )
+    (prefix / "default-site.conf").write_text(
+        NGINX_CONF.format(
+            nginx_port=nginx_port,
+            macroverse_port=environment_server_port,
+            include_dir=include_dir,
+            static_dir=prefix / "static",
+            cache_dir=prefix / "cache",
+            activity_log="",
+        )
+    )
+    (prefix / "nginx.conf").write_text(NGINX_MAIN_CONF.format(prefix=prefix))
+    confs = [path.read_text() for path in include_dir.iterdir()]
+    size = sum(len(conf) for conf in confs)
+    locations = sum(conf.count("location ") for conf in confs)
+    return size, locations, urls
+
+
+async def handle(stream: SocketStream) -> None:
+    async with stream:
+        await stream.receive()
+        await stream.send(
+            b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok"
+        )
+
+
+async def measure(
+    prefix: Path, nginx_port: int, urls: list[str], requests: int
+) -> list[float]:
+    nginx = await open_process(["nginx", "-p", str(prefix), "-c", "nginx.conf"])
+    latencies = []
+    try:
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{nginx_port}"
+        ) as client:
+            while True:
+                try:
+                    await client.get("/")
+                    break
+                except httpx.TransportError:
+                    await anyio.sleep(0.1)
+            for i in range(requests):
+                # the last servers' locations are the last to be matched
+                url = urls[-1 - i % min(len(urls), 10)]
+                t0 = time.perf_counter()
+                response = await client.get(url)
+                latencies.append(time.perf_counter() - t0)
+                assert response.status_code == 200, response.status_code
+    finally:
+        nginx.terminate()
+        await nginx.wait()
+    return latencies
+
+
+async def run(servers: int, environments: int, requests: int) -> None:
+    nginx_port, environment_server_port = get_unused_tcp_ports(2)
+    has_nginx = shutil.which("nginx") is not None
+    if not has_nginx:
+        print("nginx not found, only measuring the configuration size")
+    listener = await anyio.create_tcp_listener(
+        local_host="127.0.0.1", local_port=environment_server_port
+    )
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(listener.serve, handle)
+        for routing in ("regex", "prefix"):
+            with tempfile.TemporaryDirectory() as tmp:
+                prefix = Path(tmp)
+                size, locations, urls = write_conf(
+                    prefix,
+                    routing,
+                    servers,
+                    environments,
+                    nginx_port,
+                    environment_server_port,
+                )
+                result = f"{routing:>6}: {size / 1e6:8.3f} MB, {locations:7} locations"
+                if has_nginx:
+                    latencies = sorted(
+                        await measure(prefix, nginx_port, urls, requests)
+                    )
+                    p50 = statistics.median(latencies) * 1e3
+                    p99 = latencies[int(len(latencies) * 0.99)] * 1e3
+                    result += f", p50 {p50:.3f} ms, p99 {p99:.3f} ms"
+                print(result)
+        tg.cancel_scope.cancel()
+
+
+@app.default
+def main(servers: int = 100, environments: int = 5, requests: int = 1000) -> None:
+    """Compare the routing modes.
+
+    Args:
+        servers: The number of servers.
+        environments: The number of environments in each server.
+        requests: The number of requests to measure the latency.
+    """
+    print(f"{servers} servers with {environments} environments each")
+    anyio.run(run, servers, environments, requests)
+
+
+if __name__ == "__main__":
+    sys.exit(app())
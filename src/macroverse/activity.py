@@ -0,0 +1,69 @@
+from collections import Counter
+
+import psutil
+from anyio import Path, open_file
+
+
+class ActivityLog:
+    # NGINX logs the time and upstream address of every request in this file,
+    # which tells when each environment server (by port) was last used
+    def __init__(self, path: Path, max_size: int = 10_000_000) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.offset = 0
+
+    async def read(self) -> dict[int, float]:
+        activity: dict[int, float] = {}
+        if not await self.path.exists():
+            return activity
+
+        if (await self.path.stat()).st_size < self.offset:
+            self.offset = 0
+        async with await open_file(self.path, "rb") as f:
+            await f.seek(self.offset)
+            data = await f.read()
+        # a line may still be being written
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        for line in data[:end].decode(errors="replace").splitlines():
+            msec, _, upstream_addrs = line.partition(" ")
+            for upstream_addr in upstream_addrs.split(", "):
+                # "127.0.0.1:{port}" or "unix:{socket_dir}/{port}.sock"
+                address = upstream_addr.rpartition(":")[2].removesuffix(".sock")
+                port = address.rpartition("/")[2]
+                if port.isdigit():
+                    activity[int(port)] = float(msec)
+        if self.offset > self.max_size:
+            # NGINX appends to the file, it can be truncated under its feet
+            await self.path.write_bytes(b"")
+            self.offset = 0
+        return activity
+
+
+def get_connected_ports(ports: set[int]) -> set[int] | None:
+    # requests that are still going on, like WebSockets, are only logged when they end;
+    # None if the connections cannot be listed (without privileges on some platforms)
+    try:
+        connections = psutil.net_connections(kind="tcp")
+        unix_connections = psutil.net_connections(kind="unix")
+    except psutil.AccessDenied:
+        return None
+
+    # the server's end, or NGINX's end of a connection to a server on another host
+    connected_ports = {
+        address.port
+        for connection in connections
+        if connection.status == psutil.CONN_ESTABLISHED
+        for address in (connection.laddr, connection.raddr)
+        if address and address.port in ports
+    }
+    # a server on a unix socket listens on "{port}.sock:{port}", and the connections
+    # it accepts have the same path as the listening socket
+    paths = Counter(
+        connection.laddr for connection in unix_connections if connection.laddr
+    )
+    for path, number in paths.items():
+        port = str(path).rpartition(":")[2]
+        if number > 1 and port.isdigit() and int(port) in ports:
+            connected_ports.add(int(port))
+    return connected_ports
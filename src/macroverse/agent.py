@@ -0,0 +1,260 @@
+import hmac
+import ipaddress
+import os
+import shutil
+import signal
+from dataclasses import replace
+from typing import Any
+
+import psutil
+import structlog
+from anycorn import Config as AnycornConfig
+from anycorn import serve
+from anyio import (
+    CancelScope,
+    Event,
+    Lock,
+    Path,
+    create_task_group,
+    open_signal_receiver,
+    to_thread,
+)
+from anyio.abc import Process
+from fastapi import Depends, FastAPI, HTTPException, Request
+from pydantic import BaseModel
+
+from .config import Config
+from .containers.base import load_lock
+from .containers.process import Container
+from .utils import check_environment_name, is_tcp_port_free
+
+
+logger = structlog.get_logger()
+
+
+class EnvironmentRequest(BaseModel):
+    definition: dict[str, Any]
+    lock: str | None = None
+
+
+class ServerRequest(BaseModel):
+    environment: str
+    id: str
+    port: int
+
+
+class Agent:
+    # runs on a worker node: builds environments and runs their servers for a hub,
+    # which uses the "remote" container type
+    def __init__(self, root: Path, config: Config, max_servers: int) -> None:
+        self.env_dir = root / "environments"
+        self.config = config
+        self.max_servers = max_servers or os.cpu_count() or 1
+        self.containers: dict[str, Container] = {}
+        self.build_locks: dict[str, Lock] = {}
+        # by port, with the name of their environment
+        self.servers: dict[int, tuple[str, Process]] = {}
+
+    async def start(self) -> None:
+        await self.env_dir.mkdir(parents=True, exist_ok=True)
+        async for env_path in self.env_dir.iterdir():
+            if await (env_path / "environment.lock").exists():
+                self.containers[
+                    env_path.name
+                ] = await Container.from_existing_environment(env_path)
+            else:
+                # the build was interrupted
+                await to_thread.run_sync(shutil.rmtree, env_path, True)
+        logger.info(f"Agent has {len(self.containers)} environments")
+
+    async def stop(self) -> None:
+        async with create_task_group() as tg:
+            for port in list(self.servers):
+                tg.start_soon(self.stop_server, port, False)
+
+    def get_status(self) -> dict[str, Any]:
+        return {
+            "max_servers": self.max_servers,
+            "cpu_count": os.cpu_count(),
+            "load": os.getloadavg()[0],
+            "memory_available": psutil.virtual_memory().available,
+            "environments": {
+                env_name: container.definition_hash
+                for env_name, container in self.containers.items()
+            },
+            # the servers that exited have a return code
+            "servers": {
+                port: process.returncode for port, (_, process) in self.servers.items()
+            },
+        }
+
+    async def create_environment(
+        self, env_name: str, definition: dict[str, Any], lock: str | None
+    ) -> str:
+        try:
+            check_environment_name(env_name)
+        except ValueError as exception:
+            raise HTTPException(422, str(exception))
+
+        async with self.build_locks.setdefault(env_name, Lock()):
+            container = self.containers.get(env_name)
+            if container is not None:
+                if container.definition == definition:
+                    assert container.path is not None
+                    return await load_lock(container.path) or ""
+
+                await self._delete_environment(env_name)
+
+            container = Container(path=self.env_dir / env_name, definition=definition)
+            # an environment with the same definition is already here, with a name
+            # that is not shorter as the prefix cannot get longer when cloned
+            source = next(
+                (
+                    source
+                    for name, source in self.containers.items()
+                    if source.definition_hash == container.definition_hash
+                    and len(name) >= len(env_name)
+                ),
+                None,
+            )
+            logger.info(f"Creating environment: {env_name}")
+            try:
+                if source is None:
+                    await container.create_environment(self.config, lock)
+                else:
+                    await container.clone_environment(source)
+            except BaseException:
+                with CancelScope(shield=True):
+                    await to_thread.run_sync(shutil.rmtree, container.path, True)
+                raise
+            self.containers[env_name] = container
+            assert container.path is not None
+            return await load_lock(container.path) or ""
+
+    async def delete_environment(self, env_name: str) -> None:
+        async with self.build_locks.setdefault(env_name, Lock()):
+            await self._delete_environment(env_name)
+
+    async def _delete_environment(self, env_name: str) -> None:
+        for port, (server_env_name, _) in list(self.servers.items()):
+            if server_env_name == env_name:
+                await self.stop_server(port, False)
+        container = self.containers.pop(env_name, None)
+        if container is not None:
+            logger.info(f"Deleting environment: {env_name}")
+            await to_thread.run_sync(shutil.rmtree, container.path, True)
+
+    async def start_server(self, env_name: str, id: str, port: int) -> None:
+        async with self.build_locks.setdefault(env_name, Lock()):
+            container = self.containers.get(env_name)
+            if container is None:
+                raise HTTPException(404, f"No environment: {env_name}")
+            # the hub only knows that the port is free on its host
+            if port in self.servers or not is_tcp_port_free(port):
+                raise HTTPException(409, f"Port already used: {port}")
+
+            # the server's base URL has the ID that the hub gave the environment
+            container.id = id
+            logger.info(f'Starting server for environment "{env_name}" at {port}')
+            process = await container.start_server(port, self.config)
+            self.servers[port] = (env_name, process)
+
+    async def stop_server(self, port: int, kill: bool) -> int | None:
+        if port not in self.servers:
+            return None
+
+        env_name, process = self.servers[port]
+        container = self.containers[env_name]
+        logger.info(f'Stopping server for environment "{env_name}" at {port}')
+        try:
+            if kill:
+                await container.kill_server(process)
+            else:
+                await container.stop_server(process)
+        finally:
+            del self.servers[port]
+        return process.returncode
+
+
+def check_agent_token(host: str, token: str) -> None:
+    # without a token, anyone who can reach the agent can run anything on the node
+    if token or host == "localhost":
+        return
+    try:
+        if ipaddress.ip_address(host).is_loopback:
+            return
+    except ValueError:
+        pass
+    raise ValueError(
+        f"An agent token (--agent-token) is required for an agent at: {host}"
+    )
+
+
+def create_app(agent: Agent, token: str) -> FastAPI:
+    def check_token(request: Request) -> None:
+        if token and not hmac.compare_digest(
+            request.headers.get("authorization", "").encode(),
+            f"Bearer {token}".encode(),
+        ):
+            raise HTTPException(401)
+
+    app = FastAPI(openapi_url=None, dependencies=[Depends(check_token)])
+
+    @app.get("/status")
+    async def get_status() -> dict[str, Any]:
+        return agent.get_status()
+
+    @app.put("/environments/{env_name}")
+    async def create_environment(
+        env_name: str, environment: EnvironmentRequest
+    ) -> dict[str, str]:
+        lock = await agent.create_environment(
+            env_name, environment.definition, environment.lock
+        )
+        return {"lock": lock}
+
+    @app.delete("/environments/{env_name}")
+    async def delete_environment(env_name: str) -> None:
+        await agent.delete_environment(env_name)
+
+    @app.post("/servers")
+    async def start_server(server: ServerRequest) -> None:
+        await agent.start_server(server.environment, server.id, server.port)
+
+    @app.delete("/servers/{port}")
+    async def stop_server(port: int, kill: bool = False) -> dict[str, int | None]:
+        return {"returncode": await agent.stop_server(port, kill)}
+
+    return app
+
+
+async def run_agent(
+    host: str, port: int, root: str, max_servers: int, config: Config
+) -> None:
+    check_agent_token(host, config.agent_token)
+    # the environment servers are reached at the same address as the agent
+    agent = Agent(Path(root), replace(config, server_host=host), max_servers)
+    await agent.start()
+    anycorn_config = AnycornConfig()
+    anycorn_config.bind = [f"{host}:{port}"]
+    logger.info("Macroverse agent running", url=f"http://{host}:{port}")
+    stop_event = Event()
+    async with create_task_group() as tg:
+        tg.start_soon(_wait_for_signal, stop_event)
+        try:
+            await serve(
+                create_app(agent, config.agent_token),  # type: ignore
+                anycorn_config,
+                shutdown_trigger=stop_event.wait,
+            )
+        finally:
+            with CancelScope(shield=True):
+                await agent.stop()
+            tg.cancel_scope.cancel()
+
+
+async def _wait_for_signal(stop_event: Event) -> None:
+    with open_signal_receiver(signal.SIGINT, signal.SIGTERM) as signals:
+        async for _ in signals:
+            stop_event.set()
+            return
@@ -0,0 +1,76 @@
+import gzip
+import hashlib
+import os
+from collections.abc import Iterator
+from pathlib import Path
+
+import httpx
+import structlog
+
+
+logger = structlog.get_logger()
+# the assets of the UI, in the package
+STATIC_DIR = Path(__file__).parent / "ui" / "static"
+STATIC_URL = "/macroverse/static/"
+# third-party assets are vendored when building the package, with
+# "python -m macroverse.assets", and loaded from their CDN if they are missing
+VENDORED_ASSETS = {
+    "pico.min.css": "https://cdn.jsdelivr.net/npm/@picocss/pico@2/css/pico.min.css",
+    "htmx.min.js": "https://unpkg.com/htmx.org@4.0.0-alpha6/dist/htmx.min.js",
+}
+COMPRESSED_SUFFIXES = {".css", ".js"}
+
+
+def get_asset_urls() -> dict[str, str]:
+    # the names only depend on the content, they are known before the assets are
+    # copied
+    urls = dict(VENDORED_ASSETS)
+    for path, _, name in _hash_assets():
+        urls[path.name] = STATIC_URL + name
+    return urls
+
+
+def prepare_assets(static_path: str | os.PathLike[str]) -> dict[str, str]:
+    # the assets are copied with their content hash in their name, so that browsers
+    # can cache them forever, and compressed once for NGINX's gzip_static
+    urls = dict(VENDORED_ASSETS)
+    static_dir = Path(static_path)
+    static_dir.mkdir(parents=True, exist_ok=True)
+    for path, data, name in _hash_assets():
+        target = static_dir / name
+        if not target.exists():
+            if path.suffix in COMPRESSED_SUFFIXES:
+                _write_bytes(static_dir / f"{name}.gz", gzip.compress(data, 9, mtime=0))
+            _write_bytes(target, data)
+        urls[path.name] = STATIC_URL + name
+    for name in VENDORED_ASSETS:
+        if not (STATIC_DIR / name).exists():
+            logger.warning(f"Asset not vendored, using its CDN: {name}")
+    return urls
+
+
+def _hash_assets() -> Iterator[tuple[Path, bytes, str]]:
+    for path in sorted(STATIC_DIR.iterdir()):
+        if not path.is_file() or path.name.startswith("."):
+            continue
+
+        data = path.read_bytes()
+        digest = hashlib.sha256(data).hexdigest()[:16]
+        yield path, data, f"{path.stem}.{digest}{path.suffix}"
+
+
+def _write_bytes(path: Path, data: bytes) -> None:
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+def download_assets() -> None:
+    for name, url in VENDORED_ASSETS.items():
+        response = httpx.get(url, follow_redirects=True)
+        response.raise_for_status()
+        (STATIC_DIR / name).write_bytes(response.content)
+
+
+if __name__ == "__main__":
+    download_assets()
@@ -0,0 +1,175 @@
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from heapq import heapify, heappop, heappush
+from itertools import count
+
+import structlog
+from anyio import CancelScope, Condition, Event, create_task_group
+from anyio.abc import TaskGroup
+
+
+logger = structlog.get_logger()
+
+
+@dataclass(order=True)
+class Build:
+    priority: int
+    sequence: int
+    name: str = field(compare=False)
+    build: Callable[[], Awaitable[None]] = field(compare=False)
+    key: str | None = field(compare=False, default=None)
+    leader: "Build | None" = field(compare=False, default=None)
+    queued: bool = field(compare=False, default=False)
+    running: bool = field(compare=False, default=False)
+    failed: bool = field(compare=False, default=False)
+    cancel_scope: CancelScope = field(compare=False, default_factory=CancelScope)
+    done: Event = field(compare=False, default_factory=Event)
+
+
+class BuildScheduler:
+    # builds run in a limited number of workers, by priority (lowest first) and in
+    # submission order, so that they don't fight for CPU, disk and package cache
+    def __init__(
+        self,
+        task_group: TaskGroup,
+        workers: int,
+        on_change: Callable[[], None] | None = None,
+    ) -> None:
+        self.task_group = task_group
+        self.workers = workers
+        # called when builds are queued, start or finish
+        self.on_change = on_change
+        self.builds: dict[str, Build] = {}
+        self.queue: list[Build] = []
+        self.leaders: dict[str, Build] = {}
+        self._sequence = count()
+        self._condition = Condition()
+
+    async def submit(
+        self,
+        name: str,
+        build: Callable[[], Awaitable[None]],
+        key: str | None = None,
+        priority: int = 0,
+        queue: bool = True,
+    ) -> None:
+        entry = Build(priority, next(self._sequence), name, build, key)
+        self.builds[name] = entry
+        if key is not None and key in self.leaders:
+            # the same build is already in flight, wait for it and reuse its result
+            entry.leader = self.leaders[key]
+            self.task_group.start_soon(self._follow, entry)
+            return
+
+        if key is not None:
+            self.leaders[key] = entry
+        if queue:
+            await self._enqueue(entry)
+        else:
+            self.task_group.start_soon(self._run, entry)
+
+    async def requeue(self, name: str, build: Callable[[], Awaitable[None]]) -> bool:
+        # continue a build that was not queued with another one that is, False if it
+        # already was
+        entry = self.builds[name]
+        if entry.queued:
+            return False
+
+        requeued = Build(entry.priority, next(self._sequence), name, build, entry.key)
+        self.builds[name] = requeued
+        if entry.key is not None and self.leaders.get(entry.key) is entry:
+            self.leaders[entry.key] = requeued
+        await self._enqueue(requeued)
+        return True
+
+    async def _enqueue(self, entry: Build) -> None:
+        entry.queued = True
+        async with self._condition:
+            heappush(self.queue, entry)
+            self._condition.notify()
+        self._changed()
+
+    async def _follow(self, entry: Build) -> None:
+        assert entry.leader is not None
+        with entry.cancel_scope:
+            await entry.leader.done.wait()
+        if entry.cancel_scope.cancel_called:
+            self._finish(entry)
+            return
+
+        failed = entry.leader.failed
+        entry.leader = None
+        if failed:
+            # nothing to reuse, build from scratch
+            if entry.key is not None:
+                self.leaders.setdefault(entry.key, entry)
+            await self._enqueue(entry)
+        else:
+            await self._run(entry)
+
+    async def _run(self, entry: Build) -> None:
+        entry.running = True
+        self._changed()
+        try:
+            with entry.cancel_scope:
+                await entry.build()
+        except Exception as exception:
+            logger.error(f"Build failed: {entry.name}", exception=repr(exception))
+            entry.failed = True
+        if entry.cancel_scope.cancel_called:
+            entry.failed = True
+        self._finish(entry)
+
+    def _finish(self, entry: Build) -> None:
+        if self.builds.get(entry.name) is entry:
+            del self.builds[entry.name]
+        if entry.key is not None and self.leaders.get(entry.key) is entry:
+            del self.leaders[entry.key]
+        entry.done.set()
+        self._changed()
+
+    def _changed(self) -> None:
+        if self.on_change is not None:
+            self.on_change()
+
+    async def _worker(self) -> None:
+        while True:
+            async with self._condition:
+                while not self.queue:
+                    await self._condition.wait()
+                entry = heappop(self.queue)
+            await self._run(entry)
+
+    async def run(self) -> None:
+        async with create_task_group() as tg:
+            for _ in range(self.workers):
+                tg.start_soon(self._worker)
+
+    async def cancel(self, name: str) -> None:
+        entry = self.builds.get(name)
+        if entry is None:
+            return
+
+        logger.info(f"Cancelling build: {name}")
+        if entry in self.queue:
+            self.queue.remove(entry)
+            heapify(self.queue)
+            entry.failed = True
+            self._finish(entry)
+        else:
+            entry.cancel_scope.cancel()
+        await entry.done.wait()
+
+    def get_position(self, name: str) -> int | None:
+        # 0 if the build is running, its place in the queue otherwise
+        entry = self.builds.get(name)
+        if entry is None:
+            return None
+
+        while entry.leader is not None:
+            entry = entry.leader
+        if entry.running:
+            return 0
+        if entry in self.queue:
+            return sorted(self.queue).index(entry) + 1
+        return None
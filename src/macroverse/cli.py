@@ -1,5 +1,11 @@
-from cyclopts import App
+import sys
+from typing import Annotated
 
+import anyio
+from cyclopts import App, Parameter
+
+from .agent import check_agent_token, run_agent
+from .config import Config
 from .main import ContainerType, MacroverseModule
 
 
@@ -10,6 +16,7 @@ app = App()
 def main(
     container: ContainerType = "process",
     open_browser: bool = False,
+    config: Annotated[Config, Parameter(name="*")] = Config(),
 ) -> None:
     """Jupyverse deployment.
 
@@ -17,9 +24,36 @@ def main(
         container: The type of container to use for launching servers.
         open_browser: Whether to automatically open a browser window.
     """
-    macroverse_module = MacroverseModule(container, open_browser)
+    try:
+        config.check(container)
+    except ValueError as exception:
+        sys.exit(str(exception))
+    macroverse_module = MacroverseModule(container, open_browser, config)
     macroverse_module.run()
 
 
+@app.command
+def agent(
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    root: str = ".",
+    max_servers: int = 0,
+    config: Annotated[Config, Parameter(name="*")] = Config(),
+) -> None:
+    """Run an agent on a worker node, for a hub with the "remote" container type.
+
+    Args:
+        host: The address that the hub reaches the agent and its environment servers at.
+        port: The port of the agent.
+        root: The directory where the environments are created.
+        max_servers: The maximum number of environment servers (defaults to the number of CPUs).
+    """
+    try:
+        check_agent_token(host, config.agent_token)
+    except ValueError as exception:
+        sys.exit(str(exception))
+    anyio.run(run_agent, host, port, root, max_servers, config)
+
+
 if __name__ == "__main__":
     app()
@@ -0,0 +1,100 @@
+import sys
+from dataclasses import dataclass, field
+
+from .utils import Routing, Transport
+
+
+@dataclass
+class Config:
+    persist_state: bool = False
+    """Keep NGINX and the environment servers running when macroverse stops, and reattach to them when it starts again."""
+
+    nginx_reload_delay: float = 0.1
+    """Seconds to wait for other changes before writing the NGINX configuration and reloading NGINX."""
+
+    nginx_routing: Routing = "prefix"
+    """How NGINX routes requests to environment servers: with one location per environment ("prefix") or one regex location per route ("regex")."""
+
+    nginx_keepalive: int = 16
+    """Idle connections to each environment server that every NGINX worker keeps open for reuse (0 to open one per request)."""
+
+    lazy_start: bool = False
+    """Start an environment's server on its first request, rather than when the environment is added to a server."""
+
+    build_workers: int = 2
+    """Maximum number of environments built at the same time, the others wait in a queue."""
+
+    package_cache: str = ""
+    """Package cache directory shared by the process environments (defaults to micromamba's). Docker builds share a BuildKit cache mount."""
+
+    channel_alias: str = ""
+    """URL that channel names are relative to when creating environments, for instance a local mirror of conda-forge."""
+
+    docker_socket: str = "/var/run/docker.sock"
+    """Path to the Docker Engine API socket, for the "docker_api" container type."""
+
+    server_transport: Transport = "tcp"
+    """How NGINX reaches the environment servers: a local TCP port ("tcp"), the same without Docker's port mapping ("host"), or a unix socket ("unix")."""
+
+    server_host: str = "127.0.0.1"
+    """Address that the process environment servers listen on (a macroverse agent uses its own address)."""
+
+    server_ports: tuple[int, int] = (20000, 29999)
+    """Range of the ports given to environment servers (first and last)."""
+
+    server_start_timeout: float = 60
+    """Seconds to wait for an environment server to start before giving up."""
+
+    warm_pool_size: int = 0
+    """Maximum number of idle servers kept ready for each environment. One is kept, more if they were recently needed."""
+
+    warm_pool_sizes: dict[str, int] = field(default_factory=dict)
+    """Maximum number of idle servers kept ready for specific environments, overriding --warm-pool-size."""
+
+    warm_pool_demand_window: float = 3600
+    """Seconds during which a server taken from an environment's warm pool counts towards its size."""
+
+    replicas: int = 1
+    """Number of servers run for each environment in use. The requests of a server always go to the same one, the least used when the environment was added to it."""
+
+    max_replicas: int = 0
+    """Maximum number of servers run for a busy environment, more than --replicas are started while their CPU usage is above --replica-cpu-percent (0 to disable)."""
+
+    replica_cpu_percent: float = 80
+    """Average CPU usage of the servers of an environment and their kernels, in percent of a core, above which another one is started. Below a third of it, one that no server uses is stopped."""
+
+    replica_scale_interval: float = 30
+    """Seconds between checks of the number of servers of each environment."""
+
+    cull_idle_timeout: float = 0
+    """Seconds without requests after which an environment server is stopped, until it gets a request again (0 to keep idle servers)."""
+
+    cull_memory_percent: float = 0
+    """Percentage of the host memory in use above which the least recently used idle environment servers are stopped (0 to disable)."""
+
+    cull_interval: float = 60
+    """Seconds between checks for environment servers to stop."""
+
+    agents: list[str] = field(default_factory=list)
+    """URLs of the macroverse agents running on the worker nodes, for the "remote" container type, for instance "http://worker1:8765"."""
+
+    agent_token: str = ""
+    """Token that the hub and the macroverse agents authenticate with."""
+
+    agent_status_interval: float = 2
+    """Seconds between requests for the status (capacity, environments and servers) of the macroverse agents."""
+
+    trace_file: str = ""
+    """Path of a JSON-lines file to append the tracing spans of the hub operations to."""
+
+    trace_otlp_endpoint: str = ""
+    """URL of an OTLP/HTTP collector to send the tracing spans to, for instance "http://localhost:4318/v1/traces"."""
+
+    def check(self, container: str) -> None:
+        # the options that cannot be used together, or on this platform
+        if self.server_transport == "unix" and sys.platform == "win32":
+            raise ValueError('The "unix" server transport is not available on Windows')
+        if container == "remote" and self.server_transport != "tcp":
+            raise ValueError(
+                'The "remote" container type only supports the "tcp" server transport'
+            )
@@ -1,10 +1,24 @@
+import json
+import os
+import signal
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
+from signal import Signals
 from typing import Any
 from uuid import UUID, uuid4
 
-from anyio import Path
-from anyio.abc import Process
+import psutil
+from anyio import Event, Path, open_process
+from anyio.abc import ByteReceiveStream, ByteSendStream, Process
+from yaml import load
+
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+from ..config import Config
+from ..utils import atomic_write_text, get_upstream, hash_environment_definition
 
 
 @dataclass
@@ -13,17 +27,188 @@ class Container(ABC):
     path: Path | None = None
     definition: dict[str, Any] | None = None
     port: int | None = None
+    socket: str | None = None
+    # the host that the server runs on, None for this one
+    host: str | None = None
     process: Process | None = None
-    create_time: int | None = None
+    # when the environment creation started, None once it is created
+    create_time: float | None = None
     nginx_conf: str | None = None
+    # the NGINX upstreams of its servers, outside of the server block
+    nginx_upstream_conf: str | None = None
     routes: list[dict[str, Any]] = field(default_factory=list)
+    last_activity: float | None = None
+
+    @property
+    def definition_hash(self) -> str | None:
+        if self.definition is None:
+            return None
+        return hash_environment_definition(self.definition)
+
+    @property
+    def upstream(self) -> str | None:
+        return get_upstream(self.port)
+
+    @property
+    def fallback(self) -> str:
+        # the NGINX location that starts the server on request
+        return f"environment_{self.id}"
 
     @classmethod
     @abstractmethod
     async def from_existing_environment(cls, env_path: Path) -> "Container": ...
 
     @abstractmethod
-    async def create_environment(self) -> None: ...
+    async def create_environment(self, config: Config, lock: str | None = None) -> None:
+        # with a lock (an explicit list of packages), the solver is skipped
+        ...
+
+    @abstractmethod
+    async def clone_environment(self, source: "Container") -> None: ...
+
+    def get_server_host(self, process: Process) -> str | None:
+        # the host that a server runs on, None for this one
+        return None
+
+    @abstractmethod
+    async def start_server(
+        self, port: int, config: Config, socket: str | None = None
+    ) -> Process:
+        # with a socket the server listens on "{socket}:{port}"
+        ...
+
+    @abstractmethod
+    async def stop_server(self, process: Process) -> None: ...
 
     @abstractmethod
-    def get_server_command(self, port: int) -> str: ...
+    async def kill_server(self, process: Process) -> None: ...
+
+    async def delete_environment(self, config: Config) -> None:
+        # for backends that keep environments elsewhere than in their directory
+        return
+
+    @classmethod
+    async def run(cls, config: Config) -> None:
+        # runs as long as the hub, for backends that need it
+        return
+
+
+class LocalProcessContainer(Container):
+    # the servers are processes launched on this host, a string command is run in a
+    # shell
+    @abstractmethod
+    def get_server_command(
+        self, port: int, config: Config, socket: str | None = None
+    ) -> str | list[str]: ...
+
+    async def start_server(
+        self, port: int, config: Config, socket: str | None = None
+    ) -> Process:
+        cmd = self.get_server_command(port, config, socket)
+        # in its own session, a server can outlive macroverse
+        return await open_process(
+            cmd,
+            stdout=None,
+            stderr=None,
+            start_new_session=config.persist_state,
+        )
+
+    async def stop_server(self, process: Process) -> None:
+        try:
+            children = psutil.Process(process.pid).children(recursive=True)
+        except psutil.NoSuchProcess:
+            children = []
+        if children:
+            os.kill(children[0].pid, signal.SIGINT)
+        await process.wait()
+
+    async def kill_server(self, process: Process) -> None:
+        try:
+            children = psutil.Process(process.pid).children(recursive=True)
+        except psutil.NoSuchProcess:
+            children = []
+        for child in children:
+            try:
+                child.kill()
+            except psutil.NoSuchProcess:
+                pass
+        if process.returncode is None:
+            process.kill()
+        await process.wait()
+
+
+class ExternalProcess(Process):
+    # a server that is not a child process of the hub, whose exit is reported by
+    # whatever runs it
+    def __init__(self) -> None:
+        self._returncode: int | None = None
+        self._exited = Event()
+
+    def set_returncode(self, returncode: int | None) -> None:
+        # the exit code is not always known
+        self._returncode = -1 if returncode is None else returncode
+        self._exited.set()
+
+    async def aclose(self) -> None:
+        await self.wait()
+
+    async def wait(self) -> int:
+        await self._exited.wait()
+        assert self._returncode is not None
+        return self._returncode
+
+    def terminate(self) -> None:
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self) -> None:
+        self.send_signal(signal.SIGKILL)
+
+    @abstractmethod
+    def send_signal(self, signal: Signals) -> None: ...
+
+    @property
+    def pid(self) -> int:
+        # not a local process
+        return 0
+
+    @property
+    def returncode(self) -> int | None:
+        return self._returncode
+
+    @property
+    def stdin(self) -> ByteSendStream | None:
+        return None
+
+    @property
+    def stdout(self) -> ByteReceiveStream | None:
+        return None
+
+    @property
+    def stderr(self) -> ByteReceiveStream | None:
+        return None
+
+
+async def load_definition(env_path: Path) -> dict[str, Any] | None:
+    environment_path = env_path / "environment.yaml"
+    if not await environment_path.exists():
+        return None
+    return load(await environment_path.read_text(), Loader=Loader)
+
+
+async def load_lock(env_path: Path) -> str | None:
+    lock_path = env_path / "environment.lock"
+    if not await lock_path.exists():
+        return None
+    return await lock_path.read_text()
+
+
+async def load_routes(env_path: Path) -> list[dict[str, Any]]:
+    # the routes of the environment server, from the last time it was started
+    routes_path = env_path / "routes.json"
+    if not await routes_path.exists():
+        return []
+    return json.loads(await routes_path.read_text())
+
+
+async def save_routes(env_path: Path, routes: list[dict[str, Any]]) -> None:
+    await atomic_write_text(env_path / "routes.json", json.dumps(routes))
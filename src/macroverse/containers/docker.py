@@ -1,4 +1,9 @@
-from anyio import Path, run_process
+import os
+import re
+from typing import Any
+
+import structlog
+from anyio import Lock, Path, TemporaryDirectory, run_process
 from yaml import dump
 
 try:
@@ -6,39 +11,181 @@ try:
 except ImportError:
     from yaml import Dumper
 
+from ..config import Config
+from ..tracing import span
+from ..utils import hash_environment_definition
 from .base import Container as _Container
+from .base import LocalProcessContainer, load_definition, load_lock, load_routes
+
+
+logger = structlog.get_logger()
 
 
-class Container(_Container):
+class Container(LocalProcessContainer):
     @classmethod
     async def from_existing_environment(cls, env_path: Path) -> "Container":
         dockerfile = await (env_path / "Dockerfile").read_text()
         environment_id = dockerfile.splitlines()[-1][2:]
-        return cls(id=environment_id, path=env_path)
+        definition = await load_definition(env_path)
+        routes = await load_routes(env_path)
+        return cls(
+            id=environment_id, path=env_path, definition=definition, routes=routes
+        )
 
-    def get_server_command(self, port: int) -> str:
-        launch_jupyverse_cmd = f'jupyverse --host 0.0.0.0 --port 5000 --set frontend.base_url=/jupyverse/{self.id}/ --set openapi_url="" --set routes_url="/routes" --timeout 10'
-        cmd = f"docker run -p {port}:5000 {self.id} {launch_jupyverse_cmd}"
+    def get_server_command(
+        self, port: int, config: Config, socket: str | None = None
+    ) -> str:
+        if socket is not None:
+            # the socket directory is shared, and the socket must belong to the
+            # user NGINX runs as
+            socket_dir = os.path.dirname(socket)
+            run_options = (
+                f"--user {os.getuid()}:{os.getgid()} -v {socket_dir}:{socket_dir}"
+            )
+            launch_jupyverse_cmd = self.get_jupyverse_command(f"unix:{socket}", port)
+        elif config.server_transport == "host":
+            # no port mapping between NGINX and the server
+            run_options = "--network host"
+            launch_jupyverse_cmd = self.get_jupyverse_command("127.0.0.1", port)
+        else:
+            run_options = f"-p {port}:5000"
+            launch_jupyverse_cmd = self.get_jupyverse_command()
+        cmd = f"docker run {run_options} {self.id} {launch_jupyverse_cmd}"
         return cmd
 
-    async def create_environment(self) -> None:
+    def get_jupyverse_command(self, host: str = "0.0.0.0", port: int = 5000) -> str:
+        # by default the server listens on port 5000 inside the container
+        return f'jupyverse --host {host} --port {port} --set frontend.base_url=/jupyverse/{self.id}/ --set openapi_url="" --set routes_url="/routes" --timeout 10'
+
+    async def create_environment(self, config: Config, lock: str | None = None) -> None:
+        assert self.definition is not None
+        base_definition, _ = split_definition(self.definition)
+        await build_base_image(base_definition, config)
+        await self._write_build_context(lock)
+        assert self.path is not None
+        await build_image(str(self.id), self.path, config)
+        export_lock_cmd = (
+            f"docker run --rm {self.id} micromamba env export -n base --explicit --md5"
+        )
+        with span("export_lock"):
+            result = await run_process(export_lock_cmd, stderr=None)
+        await (self.path / "environment.lock").write_bytes(result.stdout)
+
+    async def clone_environment(self, source: _Container) -> None:
+        # same environment, so the image can just be tagged again
+        assert source.path is not None
+        lock = await load_lock(source.path)
+        await self._write_build_context(lock)
+        tag_docker_image_cmd = f"docker tag {source.id} {self.id}"
+        await run_process(tag_docker_image_cmd, stdout=None, stderr=None)
+
+    async def _write_build_context(self, lock: str | None) -> None:
         assert self.definition is not None
         self.definition["name"] = "base"
         environment_str = dump(self.definition, Dumper=Dumper)
         assert self.path is not None
         await self.path.mkdir(parents=True)
         await (self.path / "environment.yaml").write_text(environment_str)
-        dockerfile_str = DOCKERFILE.replace("ENVIRONMENT_ID", str(self.id))
+        base_definition, layer_definition = split_definition(self.definition)
+        if lock is None:
+            # only what is not in the base image
+            environment_file = "layer.yaml"
+            layer_str = dump(layer_definition, Dumper=Dumper)
+            await (self.path / environment_file).write_text(layer_str)
+        else:
+            environment_file = "environment.lock"
+            await (self.path / environment_file).write_text(lock)
+        dockerfile_str = get_dockerfile(
+            get_base_image(base_definition), environment_file, str(self.id)
+        )
         await (self.path / "Dockerfile").write_text(dockerfile_str)
-        build_docker_image_cmd = f"docker build --tag {self.id} {self.path}"
-        await run_process(build_docker_image_cmd, stdout=None, stderr=None)
 
 
+# installed in a base image shared by the environments that have the same ones
+SERVER_PACKAGES = ("jupyverse", "fps", "anycorn")
+_base_image_locks: dict[str, Lock] = {}
+
+
+def split_definition(
+    definition: dict[str, Any],
+) -> tuple[dict[str, Any], dict[str, Any]]:
+    base_dependencies = []
+    layer_dependencies = []
+    for dependency in definition.get("dependencies", []):
+        if isinstance(dependency, str) and re.match(
+            rf"({'|'.join(SERVER_PACKAGES)})\b", dependency.strip()
+        ):
+            base_dependencies.append(dependency)
+        else:
+            layer_dependencies.append(dependency)
+    base_definition = {
+        key: val for key, val in definition.items() if key != "dependencies"
+    }
+    layer_definition = dict(base_definition)
+    base_definition["dependencies"] = base_dependencies
+    layer_definition["dependencies"] = layer_dependencies
+    return base_definition, layer_definition
+
+
+def get_base_image(base_definition: dict[str, Any]) -> str:
+    if not base_definition["dependencies"]:
+        return MICROMAMBA_IMAGE
+    definition_hash = hash_environment_definition(base_definition)
+    return f"macroverse-base:{definition_hash[:16]}"
+
+
+def get_dockerfile(base_image: str, environment_file: str, environment_id: str) -> str:
+    dockerfile_str = DOCKERFILE.replace("BASE_IMAGE", base_image)
+    dockerfile_str = dockerfile_str.replace("ENVIRONMENT_FILE", environment_file)
+    return dockerfile_str.replace("ENVIRONMENT_ID", environment_id)
+
+
+async def build_base_image(base_definition: dict[str, Any], config: Config) -> None:
+    base_image = get_base_image(base_definition)
+    if base_image == MICROMAMBA_IMAGE:
+        return
+
+    # built once, even if environments using it are created at the same time
+    async with _base_image_locks.setdefault(base_image, Lock()):
+        inspect_image_cmd = f"docker image inspect {base_image}"
+        result = await run_process(inspect_image_cmd, check=False)
+        if result.returncode == 0:
+            return
+
+        logger.info(f"Building base image: {base_image}")
+        with span("build_base_image", image=base_image):
+            async with TemporaryDirectory() as context_dir:
+                context_path = Path(context_dir)
+                base_str = dump(base_definition, Dumper=Dumper)
+                await (context_path / "environment.yaml").write_text(base_str)
+                dockerfile_str = get_dockerfile(
+                    MICROMAMBA_IMAGE, "environment.yaml", base_image
+                )
+                await (context_path / "Dockerfile").write_text(dockerfile_str)
+                await build_image(base_image, context_path, config)
+
+
+async def build_image(tag: str, context_path: Path, config: Config) -> None:
+    build_docker_image_cmd = f"docker build --tag {tag} {context_path}"
+    if config.channel_alias:
+        build_docker_image_cmd += f" --build-arg CHANNEL_ALIAS={config.channel_alias}"
+    # cache mounts need BuildKit
+    env = dict(os.environ, DOCKER_BUILDKIT="1")
+    with span("build_image", image=tag):
+        await run_process(build_docker_image_cmd, stdout=None, stderr=None, env=env)
+
+
+# the package cache is kept in a cache mount shared by all the builds,
+# owned by the image's default user (57439)
+MICROMAMBA_IMAGE = "mambaorg/micromamba:2.4.0"
 DOCKERFILE = """\
-FROM mambaorg/micromamba:2.4.0
+# syntax=docker/dockerfile:1
+FROM BASE_IMAGE
 
-COPY --chown=$MAMBA_USER:$MAMBA_USER environment.yaml /tmp/env.yaml
-RUN micromamba install -y -n base -f /tmp/env.yaml &&  micromamba clean --all --yes
+ARG CHANNEL_ALIAS
+COPY --chown=$MAMBA_USER:$MAMBA_USER ENVIRONMENT_FILE /tmp/ENVIRONMENT_FILE
+RUN --mount=type=cache,id=macroverse-pkgs,target=/opt/conda/pkgs,uid=57439,gid=57439,sharing=locked \\
+    micromamba install -y -n base -f /tmp/ENVIRONMENT_FILE ${CHANNEL_ALIAS:+--channel-alias $CHANNEL_ALIAS}
 ARG MAMBA_DOCKERFILE_ACTIVATE=1
 EXPOSE 5000
 # ENVIRONMENT_ID
@@ -0,0 +1,226 @@
+import json
+import os
+import shlex
+from signal import Signals
+from typing import Any
+
+import httpx
+import structlog
+from anyio import CancelScope, create_task_group, sleep
+from anyio.abc import Process, TaskGroup
+
+from ..config import Config
+from ..tracing import span
+from . import docker
+from .base import ExternalProcess
+
+
+logger = structlog.get_logger()
+# the stop signal can be chosen since API v1.42
+API_VERSION = "v1.43"
+LABEL = "macroverse"
+# seconds that a server has to stop before it is killed, as jupyverse's --timeout
+STOP_TIMEOUT = 10
+
+
+class DockerClient:
+    # environment servers are managed through the Docker Engine API, images are
+    # still built with the CLI, which uses BuildKit
+    def __init__(self, socket: str) -> None:
+        # connections to the socket are pooled and reused between requests
+        self.client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(uds=socket),
+            base_url=f"http://docker/{API_VERSION}",
+        )
+        self.processes: dict[str, DockerProcess] = {}
+        # the requests of the signals, which the Process interface sends synchronously
+        self.task_group: TaskGroup | None = None
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        response = await self.client.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response
+
+    async def run(
+        self,
+        image: str,
+        cmd: list[str],
+        host_config: dict[str, Any],
+        container_config: dict[str, Any],
+    ) -> "DockerProcess":
+        with span("create_container"):
+            response = await self.request(
+                "POST",
+                "/containers/create",
+                json={
+                    "Image": image,
+                    "Cmd": cmd,
+                    "Labels": {LABEL: ""},
+                    "HostConfig": {"AutoRemove": True, **host_config},
+                    **container_config,
+                },
+            )
+        container_id = response.json()["Id"]
+        # registered before it starts, so that its exit cannot be missed
+        process = self.processes[container_id] = DockerProcess(self, container_id)
+        try:
+            with span("start_container"):
+                await self.request("POST", f"/containers/{container_id}/start")
+        except BaseException:
+            del self.processes[container_id]
+            with CancelScope(shield=True):
+                await self.client.request(
+                    "DELETE", f"/containers/{container_id}", params={"force": "true"}
+                )
+            raise
+        return process
+
+    async def stop(self, container_id: str) -> None:
+        # jupyverse shuts down cleanly on SIGINT
+        response = await self.client.request(
+            "POST",
+            f"/containers/{container_id}/stop",
+            params={"signal": "SIGINT", "t": str(STOP_TIMEOUT)},
+            # the container is killed after the stop timeout
+            timeout=STOP_TIMEOUT + 5,
+        )
+        self._check_stopped(container_id, response)
+
+    async def kill(self, container_id: str) -> None:
+        response = await self.client.request("POST", f"/containers/{container_id}/kill")
+        self._check_stopped(container_id, response)
+
+    def _check_stopped(self, container_id: str, response: httpx.Response) -> None:
+        if response.status_code in (304, 404, 409):
+            # already stopped or removed
+            self._set_exited(container_id, None)
+        else:
+            response.raise_for_status()
+
+    def _set_exited(self, container_id: str, returncode: int | None) -> None:
+        process = self.processes.pop(container_id, None)
+        if process is not None:
+            process.set_returncode(returncode)
+
+    async def watch(self) -> None:
+        # the container state comes from the event stream, not from polling
+        params = {
+            "filters": json.dumps(
+                {"type": ["container"], "event": ["die"], "label": [LABEL]}
+            )
+        }
+        while True:
+            try:
+                async with self.client.stream(
+                    "GET", "/events", params=params, timeout=None
+                ) as response:
+                    response.raise_for_status()
+                    # the containers that died while not watching
+                    await self._sync()
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+                        event = json.loads(line)
+                        exit_code = event["Actor"]["Attributes"].get("exitCode")
+                        self._set_exited(
+                            event["Actor"]["ID"],
+                            None if exit_code is None else int(exit_code),
+                        )
+            except httpx.HTTPError as exception:
+                logger.warning(
+                    "Could not watch Docker events", exception=repr(exception)
+                )
+            await sleep(1)
+
+    async def _sync(self) -> None:
+        for container_id in list(self.processes):
+            response = await self.client.request(
+                "GET", f"/containers/{container_id}/json"
+            )
+            if response.status_code == 404:
+                self._set_exited(container_id, None)
+            elif not response.json()["State"]["Running"]:
+                self._set_exited(container_id, response.json()["State"]["ExitCode"])
+
+    async def send_signal(self, container_id: str, signal: Signals) -> None:
+        try:
+            await self.request(
+                "POST",
+                f"/containers/{container_id}/kill",
+                params={"signal": signal.name},
+            )
+        except httpx.HTTPError as exception:
+            logger.warning(
+                f"Could not send {signal.name} to container: {container_id}",
+                exception=repr(exception),
+            )
+
+    async def serve(self) -> None:
+        async with create_task_group() as tg:
+            self.task_group = tg
+            await self.watch()
+
+
+_clients: dict[str, DockerClient] = {}
+
+
+def get_client(socket: str) -> DockerClient:
+    if socket not in _clients:
+        _clients[socket] = DockerClient(socket)
+    return _clients[socket]
+
+
+class DockerProcess(ExternalProcess):
+    # its exit code is not known if the container was already removed
+    def __init__(self, client: DockerClient, container_id: str) -> None:
+        super().__init__()
+        self.client = client
+        self.container_id = container_id
+
+    def send_signal(self, signal: Signals) -> None:
+        assert self.client.task_group is not None
+        self.client.task_group.start_soon(
+            self.client.send_signal, self.container_id, signal
+        )
+
+
+class Container(docker.Container):
+    async def start_server(
+        self, port: int, config: Config, socket: str | None = None
+    ) -> Process:
+        client = get_client(config.docker_socket)
+        container_config: dict[str, Any] = {}
+        if socket is not None:
+            socket_dir = os.path.dirname(socket)
+            host_config: dict[str, Any] = {"Binds": [f"{socket_dir}:{socket_dir}"]}
+            container_config["User"] = f"{os.getuid()}:{os.getgid()}"
+            launch_jupyverse_cmd = self.get_jupyverse_command(f"unix:{socket}", port)
+        elif config.server_transport == "host":
+            host_config = {"NetworkMode": "host"}
+            launch_jupyverse_cmd = self.get_jupyverse_command("127.0.0.1", port)
+        else:
+            host_config = {"PortBindings": {"5000/tcp": [{"HostPort": str(port)}]}}
+            container_config["ExposedPorts"] = {"5000/tcp": {}}
+            launch_jupyverse_cmd = self.get_jupyverse_command()
+        cmd = shlex.split(launch_jupyverse_cmd)
+        return await client.run(str(self.id), cmd, host_config, container_config)
+
+    async def stop_server(self, process: Process) -> None:
+        if not isinstance(process, DockerProcess):
+            await super().stop_server(process)
+            return
+
+        await process.client.stop(process.container_id)
+        await process.wait()
+
+    async def kill_server(self, process: Process) -> None:
+        if not isinstance(process, DockerProcess):
+            await super().kill_server(process)
+            return
+
+        await process.client.kill(process.container_id)
+        await process.wait()
+
+    @classmethod
+    async def run(cls, config: Config) -> None:
+        await get_client(config.docker_socket).serve()
@@ -1,4 +1,11 @@
-from anyio import NamedTemporaryFile, Path, run_process
+import json
+import os
+import re
+import shutil
+import signal
+
+from anyio import NamedTemporaryFile, Path, open_process, run_process, to_thread
+from anyio.abc import Process
 from yaml import dump
 
 try:
@@ -6,31 +13,232 @@ try:
 except ImportError:
     from yaml import Dumper
 
+from ..config import Config
+from ..tracing import span
+from ..utils import atomic_write_text
 from .base import Container as _Container
+from .base import LocalProcessContainer, load_definition, load_routes
+
+# set by the shell, not by the activation
+SHELL_VARIABLES = {"_", "PWD", "OLDPWD", "SHLVL"}
 
 
-class Container(_Container):
+class Container(LocalProcessContainer):
     @classmethod
     async def from_existing_environment(cls, env_path: Path) -> "Container":
-        return cls(path=env_path)
+        definition = await load_definition(env_path)
+        routes = await load_routes(env_path)
+        return cls(path=env_path, definition=definition, routes=routes)
 
-    async def create_environment(self) -> None:
-        environment_str = dump(self.definition, Dumper=Dumper)
+    async def create_environment(self, config: Config, lock: str | None = None) -> None:
+        if lock is None:
+            environment_str = dump(self.definition, Dumper=Dumper)
+            suffix = ".yaml"
+        else:
+            environment_str = lock
+            suffix = ".txt"
         async with NamedTemporaryFile(
-            mode="wb", buffering=0, suffix=".yaml"
+            mode="wb", buffering=0, suffix=suffix
         ) as environment_file:
             await environment_file.write(environment_str.encode())
             create_environment_cmd = (
                 f"micromamba create -f {environment_file.name} -p {self.path} --yes"
             )
-            await run_process(create_environment_cmd)
+            if config.channel_alias:
+                create_environment_cmd += f" --channel-alias {config.channel_alias}"
+            env = dict(os.environ)
+            if config.package_cache:
+                env["CONDA_PKGS_DIRS"] = config.package_cache
+            with span("micromamba_create"):
+                await run_process(create_environment_cmd, env=env)
+        await self._write_definition()
+        await self._write_lock()
+        await self._write_activation()
+
+    async def _write_lock(self) -> None:
+        assert self.path is not None
+        export_lock_cmd = f"micromamba env export -p {self.path} --explicit --md5"
+        with span("export_lock"):
+            result = await run_process(export_lock_cmd)
+        await (self.path / "environment.lock").write_bytes(result.stdout)
 
-    def get_server_command(self, port: int) -> str:
-        launch_jupyverse_cmd = f'jupyverse --port {port} --set frontend.base_url=/jupyverse/{self.id}/ --set openapi_url="" --set routes_url="/routes" --timeout 10'
+    async def _write_activation(self) -> dict[str, str]:
+        # the variables set by the activation scripts, so that servers can be
+        # started without a shell hook and activation on every launch
         assert self.path is not None
-        cmd = (
-            """bash -c 'eval "$(micromamba shell hook --shell bash)";"""
-            + f"micromamba activate environments/{self.path.name};"
-            + f"{launch_jupyverse_cmd}'"
+        prefix = await self.path.absolute()
+        with span("capture_activation"):
+            result = await run_process(
+                ["micromamba", "run", "-p", str(prefix), "env", "-0"]
+            )
+        activated = dict(
+            variable.partition("=")[::2]
+            for variable in result.stdout.decode().split("\0")
+            if variable
         )
-        return cmd
+        activation = {
+            name: value
+            for name, value in activated.items()
+            if os.environ.get(name) != value and name not in SHELL_VARIABLES
+        }
+        await atomic_write_text(self.path / "activation.json", json.dumps(activation))
+        return activation
+
+    async def _load_activation(self) -> dict[str, str]:
+        assert self.path is not None
+        activation_path = self.path / "activation.json"
+        if not await activation_path.exists():
+            # an environment created by an older version
+            return await self._write_activation()
+        return json.loads(await activation_path.read_text())
+
+    async def clone_environment(self, source: _Container) -> None:
+        assert source.path is not None
+        assert self.path is not None
+        src_prefix = str(await source.path.absolute())
+        dst_prefix = str(await self.path.absolute())
+        # the activation variables are copied with the prefix replaced
+        with span("clone_prefix"):
+            await to_thread.run_sync(clone_prefix, src_prefix, dst_prefix)
+        await self._write_definition()
+
+    async def _write_definition(self) -> None:
+        assert self.path is not None
+        environment_str = dump(self.definition, Dumper=Dumper)
+        await (self.path / "environment.yaml").write_text(environment_str)
+
+    def get_server_command(
+        self, port: int, config: Config, socket: str | None = None
+    ) -> list[str]:
+        host = config.server_host if socket is None else f"unix:{socket}"
+        assert self.path is not None
+        return [
+            str(self.path / "bin" / "jupyverse"),
+            "--host",
+            host,
+            "--port",
+            str(port),
+            "--set",
+            f"frontend.base_url=/jupyverse/{self.id}/",
+            "--set",
+            "openapi_url=",
+            "--set",
+            "routes_url=/routes",
+            "--timeout",
+            "10",
+        ]
+
+    async def start_server(
+        self, port: int, config: Config, socket: str | None = None
+    ) -> Process:
+        cmd = self.get_server_command(port, config, socket)
+        activation = await self._load_activation()
+        # executed directly, the process is the server itself
+        with span("spawn_server"):
+            return await open_process(
+                cmd,
+                stdout=None,
+                stderr=None,
+                env={**os.environ, **activation},
+                start_new_session=config.persist_state,
+            )
+
+    async def stop_server(self, process: Process) -> None:
+        if process.returncode is None:
+            try:
+                process.send_signal(signal.SIGINT)
+            except ProcessLookupError:
+                pass
+        await process.wait()
+
+
+def clone_prefix(src_prefix: str, dst_prefix: str) -> None:
+    # files are hardlinked, except the ones that embed the prefix (scripts, shebangs,
+    # some binaries), which are copied with the prefix replaced, like conda does
+    binary_paths = _get_binary_paths(src_prefix)
+    if binary_paths and len(dst_prefix) > len(src_prefix):
+        # in binaries it is padded with null bytes, so it cannot get longer
+        raise ValueError(f"Prefix is longer than the source's: {src_prefix}")
+    src_bytes = os.fsencode(src_prefix)
+    dst_bytes = os.fsencode(dst_prefix)
+    for root, dirs, files in os.walk(src_prefix):
+        relative_root = os.path.relpath(root, src_prefix)
+        dst_root = os.path.join(dst_prefix, relative_root)
+        os.makedirs(dst_root, exist_ok=True)
+        # metadata can be rewritten in place by later installs
+        copy_only = relative_root.split(os.sep)[0] == "conda-meta"
+        for name in dirs + files:
+            if relative_root == "." and name == "environment.yaml":
+                continue
+            src = os.path.join(root, name)
+            dst = os.path.join(dst_root, name)
+            if os.path.islink(src):
+                target = os.readlink(src)
+                if target.startswith(src_prefix):
+                    target = dst_prefix + target[len(src_prefix) :]
+                os.symlink(target, dst)
+            elif name in files:
+                path = os.path.normpath(os.path.join(relative_root, name))
+                binary = path.replace(os.sep, "/") in binary_paths
+                _clone_file(src, dst, src_bytes, dst_bytes, copy_only, binary)
+
+
+def _get_binary_paths(prefix: str) -> set[str]:
+    # the files in which the package metadata says the prefix is a C string
+    binary_paths = set()
+    meta_dir = os.path.join(prefix, "conda-meta")
+    for name in os.listdir(meta_dir) if os.path.isdir(meta_dir) else []:
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(meta_dir, name)) as f:
+            meta = json.load(f)
+        for path in meta.get("paths_data", {}).get("paths", []):
+            if path.get("file_mode") == "binary":
+                binary_paths.add(path["_path"])
+    return binary_paths
+
+
+def _clone_file(
+    src: str,
+    dst: str,
+    src_prefix: bytes,
+    dst_prefix: bytes,
+    copy_only: bool,
+    binary: bool,
+) -> None:
+    with open(src, "rb") as f:
+        data = f.read()
+    if src_prefix in data and src.endswith(".pyc"):
+        # the marshalled code cannot be edited, Python compiles it again
+        return
+
+    if src_prefix not in data:
+        if not copy_only:
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                pass
+        shutil.copy2(src, dst)
+        return
+
+    if binary:
+        data = _replace_binary_prefix(data, src_prefix, dst_prefix)
+    else:
+        data = data.replace(src_prefix, dst_prefix)
+    with open(dst, "wb") as f:
+        f.write(data)
+    shutil.copymode(src, dst)
+
+
+def _replace_binary_prefix(data: bytes, src_prefix: bytes, dst_prefix: bytes) -> bytes:
+    # C strings must keep their length, pad them with null bytes
+    def replace(match: re.Match) -> bytes:
+        occurrences = match.group().count(src_prefix)
+        padding = (len(src_prefix) - len(dst_prefix)) * occurrences
+        if padding < 0:
+            raise ValueError("New prefix is too long for binary file")
+        return match.group().replace(src_prefix, dst_prefix) + b"\0" * padding
+
+    pattern = re.compile(re.escape(src_prefix) + b"[^\0]*\0", re.DOTALL)
+    return pattern.sub(replace, data)
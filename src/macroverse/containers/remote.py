@@ -0,0 +1,269 @@
+from signal import Signals
+from typing import Any
+from urllib.parse import urlsplit
+
+import httpx
+import structlog
+from anyio import Path, create_task_group, sleep
+from anyio.abc import Process, TaskGroup
+from yaml import dump
+
+try:
+    from yaml import CDumper as Dumper
+except ImportError:
+    from yaml import Dumper
+
+from ..config import Config
+from ..tracing import span
+from ..utils import hash_environment_definition
+from .base import Container as _Container
+from .base import ExternalProcess, load_definition, load_lock, load_routes
+
+
+logger = structlog.get_logger()
+# a node that has the environment is preferred, unless it is this much more loaded
+LOCALITY_LOAD = 0.25
+
+
+class WorkerNode:
+    # a worker node, as last reported by its macroverse agent
+    def __init__(self, url: str, token: str) -> None:
+        self.url = url
+        self.host = urlsplit(url).hostname or "localhost"
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        self.client = httpx.AsyncClient(base_url=url, headers=headers, timeout=None)
+        self.available = False
+        self.max_servers = 0
+        self.servers = 0
+        self.environments: dict[str, str] = {}
+        self.processes: dict[int, RemoteProcess] = {}
+        # the requests of the signals, which the Process interface sends synchronously
+        self.task_group: TaskGroup | None = None
+
+    @property
+    def load(self) -> float:
+        return self.servers / self.max_servers if self.max_servers else 1
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        response = await self.client.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response
+
+    async def update_status(self) -> None:
+        # a server that is not reported had exited, unless it was started since
+        started = {port for port, process in self.processes.items() if process.started}
+        try:
+            status = (await self.request("GET", "/status", timeout=10)).json()
+        except httpx.HTTPError as exception:
+            if self.available:
+                logger.warning(
+                    f"Worker node not available: {self.url}", exception=repr(exception)
+                )
+            self.available = False
+            return
+
+        if not self.available:
+            logger.info(f"Worker node available: {self.url}")
+        self.available = True
+        self.max_servers = status["max_servers"]
+        self.environments = status["environments"]
+        servers = {
+            int(port): returncode for port, returncode in status["servers"].items()
+        }
+        # including the servers being started
+        self.servers = len(servers.keys() | self.processes.keys())
+        for port in started:
+            if port not in servers:
+                self._set_exited(port, None)
+            elif servers[port] is not None:
+                self._set_exited(port, servers[port])
+
+    def _set_exited(self, port: int, returncode: int | None) -> None:
+        process = self.processes.pop(port, None)
+        if process is not None:
+            process.set_returncode(returncode)
+
+    async def create_environment(
+        self, env_name: str, definition: dict[str, Any], lock: str | None
+    ) -> str:
+        with span("remote_create_environment", node=self.url):
+            response = await self.request(
+                "PUT",
+                f"/environments/{env_name}",
+                json={"definition": definition, "lock": lock},
+            )
+        self.environments[env_name] = hash_environment_definition(definition)
+        return response.json()["lock"]
+
+    async def delete_environment(self, env_name: str) -> None:
+        await self.request("DELETE", f"/environments/{env_name}")
+        self.environments.pop(env_name, None)
+
+    async def start_server(
+        self,
+        env_name: str,
+        definition: dict[str, Any],
+        lock: str | None,
+        id: str,
+        port: int,
+    ) -> "RemoteProcess":
+        # registered before the environment is created on the node, so that it counts
+        # towards the load of the node
+        process = self.processes[port] = RemoteProcess(self, port)
+        self.servers += 1
+        try:
+            if self.environments.get(env_name) != hash_environment_definition(
+                definition
+            ):
+                logger.info(f'Creating environment "{env_name}" on node: {self.url}')
+                await self.create_environment(env_name, definition, lock)
+            with span("remote_start_server", node=self.url):
+                await self.request(
+                    "POST",
+                    "/servers",
+                    json={"environment": env_name, "id": id, "port": port},
+                )
+        except BaseException:
+            self._set_exited(port, None)
+            self.servers -= 1
+            raise
+        process.started = True
+        return process
+
+    async def stop_server(self, port: int, kill: bool) -> None:
+        response = await self.request(
+            "DELETE", f"/servers/{port}", params={"kill": kill}
+        )
+        self._set_exited(port, response.json()["returncode"])
+        self.servers = max(self.servers - 1, 0)
+
+
+_nodes: dict[str, WorkerNode] = {}
+
+
+def get_nodes(config: Config) -> list[WorkerNode]:
+    for url in config.agents:
+        if url not in _nodes:
+            _nodes[url] = WorkerNode(url, config.agent_token)
+    return [_nodes[url] for url in config.agents]
+
+
+def place_server(
+    nodes: list[WorkerNode], env_name: str, definition_hash: str | None
+) -> WorkerNode:
+    # the least loaded node, preferring the ones that already have the environment
+    # (or one with the same definition, which the agent clones)
+    candidates = [
+        node for node in nodes if node.available and node.servers < node.max_servers
+    ]
+    if not candidates:
+        raise RuntimeError("No worker node available to start a server")
+
+    def get_cost(node: WorkerNode) -> float:
+        if env_name in node.environments:
+            return node.load
+        if definition_hash in node.environments.values():
+            return node.load + LOCALITY_LOAD / 2
+        return node.load + LOCALITY_LOAD
+
+    return min(candidates, key=get_cost)
+
+
+class RemoteProcess(ExternalProcess):
+    # its exit code is not known if the agent doesn't have the server anymore
+    def __init__(self, node: WorkerNode, port: int) -> None:
+        super().__init__()
+        self.node = node
+        self.port = port
+        self.started = False
+
+    def send_signal(self, signal: Signals) -> None:
+        # the agent can only stop a server (with SIGINT) or kill it
+        assert self.node.task_group is not None
+        self.node.task_group.start_soon(self._stop, signal.name == "SIGKILL")
+
+    async def _stop(self, kill: bool) -> None:
+        try:
+            await self.node.stop_server(self.port, kill)
+        except httpx.HTTPError as exception:
+            logger.warning(
+                f"Could not stop server at {self.node.url}: {self.port}",
+                exception=repr(exception),
+            )
+
+
+class Container(_Container):
+    # the environments are built and their servers run on worker nodes, by macroverse
+    # agents; the hub keeps their definition, lock and routes
+    @classmethod
+    async def from_existing_environment(cls, env_path: Path) -> "Container":
+        definition = await load_definition(env_path)
+        routes = await load_routes(env_path)
+        return cls(path=env_path, definition=definition, routes=routes)
+
+    async def create_environment(self, config: Config, lock: str | None = None) -> None:
+        # built on a node right away, so that its first server starts faster
+        assert self.path is not None
+        assert self.definition is not None
+        node = place_server(get_nodes(config), self.path.name, self.definition_hash)
+        lock = await node.create_environment(self.path.name, self.definition, lock)
+        await self._write_environment(lock)
+
+    async def clone_environment(self, source: _Container) -> None:
+        # the nodes create it when one of its servers starts
+        assert source.path is not None
+        await self._write_environment(await load_lock(source.path) or "")
+
+    async def _write_environment(self, lock: str) -> None:
+        assert self.path is not None
+        await self.path.mkdir(parents=True, exist_ok=True)
+        await (self.path / "environment.lock").write_text(lock)
+        environment_str = dump(self.definition, Dumper=Dumper)
+        await (self.path / "environment.yaml").write_text(environment_str)
+
+    async def delete_environment(self, config: Config) -> None:
+        assert self.path is not None
+        env_name = self.path.name
+        async with create_task_group() as tg:
+            for node in get_nodes(config):
+                if node.available and env_name in node.environments:
+                    tg.start_soon(node.delete_environment, env_name)
+
+    def get_server_host(self, process: Process) -> str | None:
+        assert isinstance(process, RemoteProcess)
+        return process.node.host
+
+    async def start_server(
+        self, port: int, config: Config, socket: str | None = None
+    ) -> Process:
+        assert self.path is not None
+        assert self.definition is not None
+        env_name = self.path.name
+        lock = await load_lock(self.path)
+        node = place_server(get_nodes(config), env_name, self.definition_hash)
+        return await node.start_server(
+            env_name, self.definition, lock, str(self.id), port
+        )
+
+    async def stop_server(self, process: Process) -> None:
+        assert isinstance(process, RemoteProcess)
+        await process.node.stop_server(process.port, False)
+        await process.wait()
+
+    async def kill_server(self, process: Process) -> None:
+        assert isinstance(process, RemoteProcess)
+        await process.node.stop_server(process.port, True)
+        await process.wait()
+
+    @classmethod
+    async def run(cls, config: Config) -> None:
+        # the capacity, environments and servers of the nodes
+        nodes = get_nodes(config)
+        async with create_task_group() as signal_tg:
+            for node in nodes:
+                node.task_group = signal_tg
+            while True:
+                async with create_task_group() as tg:
+                    for node in nodes:
+                        tg.start_soon(node.update_status)
+                await sleep(config.agent_status_interval)
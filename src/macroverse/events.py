@@ -0,0 +1,42 @@
+from collections.abc import Generator
+from contextlib import contextmanager
+
+from anyio import (
+    BrokenResourceError,
+    ClosedResourceError,
+    WouldBlock,
+    create_memory_object_stream,
+)
+from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
+
+
+class EventBus:
+    # the UI is told what changed, instead of polling for it
+    def __init__(self, max_buffer_size: int = 100) -> None:
+        self.max_buffer_size = max_buffer_size
+        self.subscribers: set[MemoryObjectSendStream[str]] = set()
+
+    def publish(self, event: str) -> None:
+        for send_stream in list(self.subscribers):
+            try:
+                send_stream.send_nowait(event)
+            except WouldBlock:
+                # a subscriber that doesn't keep up is dropped, it will reconnect
+                # and refresh everything
+                send_stream.close()
+                self.subscribers.discard(send_stream)
+            except (BrokenResourceError, ClosedResourceError):
+                self.subscribers.discard(send_stream)
+
+    @contextmanager
+    def subscribe(self) -> Generator[MemoryObjectReceiveStream[str]]:
+        send_stream, receive_stream = create_memory_object_stream[str](
+            self.max_buffer_size
+        )
+        self.subscribers.add(send_stream)
+        try:
+            yield receive_stream
+        finally:
+            self.subscribers.discard(send_stream)
+            send_stream.close()
+            receive_stream.close()
@@ -1,23 +1,29 @@
 import importlib
 import os
-import signal
 import sys
 import shutil
-from typing import Literal
+import tempfile
+import time
+from collections import defaultdict
+from functools import partial
+from typing import Any, Literal
+from uuid import uuid4
 
 import httpx
 import psutil
 import structlog
 from anyio import (
+    CancelScope,
     Lock,
     Path,
     create_task_group,
+    fail_after,
     open_process,
     run_process,
     sleep,
     to_thread,
 )
-from anyio.abc import TaskGroup
+from anyio.abc import Process, TaskGroup
 from yaml import load
 
 try:
@@ -25,12 +31,45 @@ try:
 except ImportError:
     from yaml import Loader
 
-from .containers.base import Container
+from .activity import ActivityLog, get_connected_ports
+from .assets import get_asset_urls, prepare_assets
+from .builds import BuildScheduler
+from .config import Config
+from .containers.base import Container, load_lock, save_routes
+from .events import EventBus
+from .metrics import (
+    BUILD_DURATION,
+    NGINX_WRITE_DURATION,
+    SERVER_START_DURATION,
+    SERVER_STOP_DURATION,
+    collect_histograms,
+    format_metric,
+    get_process_resources,
+)
+from .nginx import NginxReloader
+from .pool import EnvironmentServer, WarmPool
 from .server import Server
-from .utils import get_unused_tcp_ports
+from .state import (
+    STATE_PATH,
+    EnvironmentServerState,
+    HubState,
+    ReattachedProcess,
+    load_state,
+)
+from .tracing import span, tracer
+from .utils import (
+    atomic_write_text,
+    PortAllocator,
+    check_environment_name,
+    get_http_client,
+    process_fallback,
+    process_prefix,
+    process_routes,
+    process_upstream,
+)
 
 
-ContainerType = Literal["process", "docker"]
+ContainerType = Literal["process", "docker", "docker_api", "remote"]
 logger = structlog.get_logger()
 
 
@@ -41,63 +80,384 @@ class Hub:
         nginx_port: int,
         macroverse_port: int,
         container_name: ContainerType,
+        config: Config | None = None,
     ) -> None:
         self.task_group = task_group
         self.nginx_port = nginx_port
         self.macroverse_port = macroverse_port
         self.container_name = container_name
+        self.config = Config() if config is None else config
         self.auth_token = None
         self.nginx_lock = Lock()
-        self.server_lock = Lock()
+        self.server_locks: dict[str, Lock] = {}
+        self.nginx_reloader = NginxReloader(
+            self.write_nginx_conf, self.config.nginx_reload_delay
+        )
+        self.warm_pool = WarmPool(
+            task_group,
+            self._launch_container_server,
+            self._stop_environment_server,
+            self.config.warm_pool_size,
+            self.config.warm_pool_sizes,
+            self.config.warm_pool_demand_window,
+        )
+        self.events = EventBus()
+        # the state changes with the version, and each entity (like
+        # "environment-{name}") with its own version
+        self.state_id = uuid4().hex
+        self.version = 0
+        self.versions: dict[str, int] = {}
+        self.build_scheduler = BuildScheduler(
+            task_group, self.config.build_workers, self._publish_builds
+        )
         self.containers: dict[str, Container] = {}
+        # the servers of a running environment other than its first one
+        self.replicas: dict[str, list[EnvironmentServer]] = defaultdict(list)
+        self.launching_replicas: dict[str, int] = defaultdict(int)
+        self.ports = PortAllocator(*self.config.server_ports)
         self.servers: dict[str, Server] = {}
+        self.build_cache: dict[str, str] = {}
         self.nginx_conf_path = (
             Path(sys.prefix) / "etc" / "nginx" / "sites.d" / "default-site.conf"
         )
+        self.nginx_include_dir = (
+            Path(sys.prefix) / "etc" / "nginx" / "sites.d" / "macroverse"
+        )
+        self.static_dir = Path(sys.prefix) / "share" / "macroverse" / "static"
+        self.nginx_cache_dir = (
+            Path(sys.prefix) / "var" / "cache" / "nginx" / "macroverse"
+        )
+        # the pages can be served before the assets are prepared in start
+        self.assets = get_asset_urls()
+        self.dirty_servers: set[str] = set()
+        self.dirty_environments: set[str] = set()
+        self.activity_log = ActivityLog(
+            Path(sys.prefix) / "var" / "log" / "nginx" / "macroverse-activity.log"
+        )
         self.Container = importlib.import_module(
             f".containers.{container_name}", package="macroverse"
         ).Container
         task_group.start_soon(self.start)
 
     async def start(self) -> None:
+        state = None
+        if self.config.persist_state:
+            state = await to_thread.run_sync(load_state)
         env_dir = Path("environments")
         if await env_dir.is_dir():
-            async for env_path in env_dir.iterdir():
-                container = await self.Container.from_existing_environment(env_path)
-                self.containers[env_path.name] = container
-        await self.write_nginx_conf()
-        await open_process("nginx")
-        logger.info("Starting nginx")
+            async with create_task_group() as tg:
+                async for env_path in env_dir.iterdir():
+                    tg.start_soon(self._load_environment, env_path, state)
+        if state is not None:
+            for uuid, env_names in state.servers.items():
+                server = Server(
+                    macroverse_port=self.macroverse_port,
+                    routing=self.config.nginx_routing,
+                    id=uuid,
+                )
+                server.environments.update(
+                    env_name for env_name in env_names if env_name in self.containers
+                )
+                self.servers[uuid] = server
+                self.update_server_nginx_conf(uuid)
+        self.assets = await to_thread.run_sync(prepare_assets, self.static_dir)
+        await self.write_nginx_main_conf()
+        nginx_running = False
+        if state is not None:
+            # NGINX kept running after the previous macroverse stopped
+            try:
+                await run_process("nginx -s reload")
+                nginx_running = True
+            except Exception:
+                pass
+        if nginx_running:
+            logger.info("Reloading nginx")
+        else:
+            await open_process("nginx")
+            logger.info("Starting nginx")
+        self.task_group.start_soon(self.nginx_reloader.run)
+        self.task_group.start_soon(self.build_scheduler.run)
+        self.task_group.start_soon(self.Container.run, self.config)
+        self.task_group.start_soon(self.warm_pool.run)
+        self.task_group.start_soon(
+            tracer.run, self.config.trace_file, self.config.trace_otlp_endpoint
+        )
+        for env_name in self.containers:
+            self.warm_pool.fill(env_name)
+        if self.culling:
+            self.task_group.start_soon(self.cull_container_servers)
+        if max(self.config.replicas, self.config.max_replicas) > 1:
+            self.task_group.start_soon(self.scale_container_servers)
+
+    @property
+    def socket_dir(self) -> Path:
+        # for the "unix" transport, which Windows doesn't have
+        return Path(tempfile.gettempdir()) / f"macroverse-{os.getuid()}"
+
+    def publish(self, event: str) -> None:
+        self.version += 1
+        self.versions[event] = self.version
+        self.events.publish(event)
+
+    @property
+    def culling(self) -> bool:
+        return bool(self.config.cull_idle_timeout or self.config.cull_memory_percent)
 
     async def stop(self) -> None:
+        if self.config.persist_state:
+            # the next macroverse reattaches to the first server of each environment,
+            # but not to the other ones or to the warm pools
+            async with create_task_group() as tg:
+                for name in list(self.warm_pool.servers):
+                    tg.start_soon(self.warm_pool.drain, name)
+                for environment_servers in self.replicas.values():
+                    for environment_server in environment_servers:
+                        tg.start_soon(self._stop_environment_server, environment_server)
+            await self.save_state()
+            return
+
         async with create_task_group() as tg:
             for name in self.containers:
                 tg.start_soon(self.stop_container_server, name, False)
             for uuid in self.servers:
                 tg.start_soon(self.stop_server, uuid, False)
+            for name in list(self.warm_pool.servers):
+                tg.start_soon(self.warm_pool.drain, name)
         try:
             logger.info("Stopping nginx")
             await run_process("nginx -s stop")
         except Exception:
             pass
 
+    async def _load_environment(self, env_path: Path, state: HubState | None) -> None:
+        env_name = env_path.name
+        try:
+            check_environment_name(env_name)
+        except ValueError:
+            logger.warning(f"Skipping environment with an invalid name: {env_name}")
+            return
+
+        container = await self.Container.from_existing_environment(env_path)
+        self.containers[env_name] = container
+        if state is not None and env_name in state.environment_servers:
+            await self._reattach_container_server(
+                env_name, state.environment_servers[env_name]
+            )
+        self.add_to_build_cache(env_name)
+        self.update_environment_nginx_conf(env_name)
+
+    async def _reattach_container_server(
+        self, env_name: str, environment_server: EnvironmentServerState
+    ) -> None:
+        try:
+            process = ReattachedProcess(
+                environment_server.pid, environment_server.create_time
+            )
+        except psutil.NoSuchProcess:
+            logger.info(f"Server for environment is gone: {env_name}")
+            return
+
+        port = environment_server.port
+        socket = environment_server.socket
+        try:
+            async with get_http_client(socket) as client:
+                response = await client.get(f"http://127.0.0.1:{port}/routes")
+                routes = response.json()
+        except Exception:
+            logger.warning(f"Server for environment is not responding: {env_name}")
+            await self.containers[env_name].kill_server(process)
+            return
+
+        logger.info(f'Reattaching server for environment "{env_name}"')
+        container = self.containers[env_name]
+        container.id = environment_server.id
+        container.port = port
+        container.socket = socket
+        self.ports.claim(port)
+        container.process = process
+        container.routes = routes
+        container.last_activity = time.time()
+
+    async def save_state(self) -> None:
+        environment_servers = {}
+        for env_name, container in self.containers.items():
+            if (
+                container.process is None
+                or container.port is None
+                or container.process.pid <= 0
+            ):
+                # not a local process
+                continue
+
+            try:
+                create_time = psutil.Process(container.process.pid).create_time()
+            except psutil.NoSuchProcess:
+                continue
+            environment_servers[env_name] = EnvironmentServerState(
+                id=str(container.id),
+                port=container.port,
+                pid=container.process.pid,
+                create_time=create_time,
+                socket=container.socket,
+            )
+        state = HubState(
+            nginx_port=self.nginx_port,
+            macroverse_port=self.macroverse_port,
+            servers={
+                uuid: sorted(server.environments)
+                for uuid, server in self.servers.items()
+            },
+            environment_servers=environment_servers,
+        )
+        await atomic_write_text(Path(STATE_PATH), state.dumps())
+
+    async def get_metrics(self) -> str:
+        # in the Prometheus text format
+        # an environment can have several servers, they are told apart by port
+        environment_servers = [
+            (env_name, "active", port, process)
+            for env_name, container in self.containers.items()
+            for port, process in [
+                (container.port, container.process),
+                *(
+                    (replica.port, replica.process)
+                    for replica in self.replicas.get(env_name, [])
+                ),
+            ]
+            if process is not None
+        ] + [
+            (env_name, "warm", environment_server.port, environment_server.process)
+            for env_name, pool in self.warm_pool.servers.items()
+            for environment_server in pool
+        ]
+        # not local processes have no PID
+        pids = {
+            process.pid for _, _, _, process in environment_servers if process.pid > 0
+        }
+        resources = await to_thread.run_sync(get_process_resources, pids)
+        building = sum(
+            container.create_time is not None for container in self.containers.values()
+        )
+        queued = len(self.build_scheduler.queue)
+        builds = len(self.build_scheduler.builds)
+        lines = [
+            *collect_histograms(),
+            *format_metric(
+                "macroverse_servers",
+                "Number of servers.",
+                "gauge",
+                [({}, len(self.servers))],
+            ),
+            *format_metric(
+                "macroverse_environments",
+                "Number of environments.",
+                "gauge",
+                [
+                    ({"state": "ready"}, len(self.containers) - building),
+                    ({"state": "building"}, building),
+                ],
+            ),
+            *format_metric(
+                "macroverse_builds",
+                "Number of environment builds.",
+                "gauge",
+                [
+                    ({"state": "queued"}, queued),
+                    ({"state": "running"}, builds - queued),
+                ],
+            ),
+            *format_metric(
+                "macroverse_environment_servers",
+                "Number of running environment servers.",
+                "gauge",
+                [
+                    (
+                        {"state": state},
+                        sum(server[1] == state for server in environment_servers),
+                    )
+                    for state in ("active", "warm")
+                ],
+            ),
+            *format_metric(
+                "macroverse_environment_server_resident_memory_bytes",
+                "Resident memory of an environment server and its kernels.",
+                "gauge",
+                [
+                    (
+                        {"environment": env_name, "state": state, "port": str(port)},
+                        resources[process.pid][0],
+                    )
+                    for env_name, state, port, process in environment_servers
+                    if process.pid in resources
+                ],
+            ),
+            *format_metric(
+                "macroverse_environment_server_cpu_seconds_total",
+                "CPU time of an environment server and its kernels.",
+                "counter",
+                [
+                    (
+                        {"environment": env_name, "state": state, "port": str(port)},
+                        resources[process.pid][1],
+                    )
+                    for env_name, state, port, process in environment_servers
+                    if process.pid in resources
+                ],
+            ),
+            *format_metric(
+                "macroverse_nginx_reload_requests_total",
+                "Number of NGINX reloads requested.",
+                "counter",
+                [({}, self.nginx_reloader.reload_requests)],
+            ),
+            *format_metric(
+                "macroverse_nginx_reloads_total",
+                "Number of NGINX reloads done.",
+                "counter",
+                [({}, self.nginx_reloader.reloads)],
+            ),
+            *format_metric(
+                "macroverse_nginx_reload_failures_total",
+                "Number of NGINX reloads that failed.",
+                "counter",
+                [({}, self.nginx_reloader.reload_failures)],
+            ),
+            *format_metric(
+                "macroverse_nginx_reloads_saved_total",
+                "Number of NGINX reloads saved by batching the requested ones.",
+                "counter",
+                [({}, self.nginx_reloader.reloads_saved)],
+            ),
+        ]
+        return "\n".join(lines) + "\n"
+
     async def create_server(self) -> None:
-        server = Server(macroverse_port=self.macroverse_port)
-        logger.info(f"Creating server: {server.id}")
-        self.servers[server.id] = server
-        await self.write_nginx_conf()
-        await run_process("nginx -s reload")
+        with span("create_server"):
+            server = Server(
+                macroverse_port=self.macroverse_port, routing=self.config.nginx_routing
+            )
+            logger.info(f"Creating server: {server.id}")
+            self.servers[server.id] = server
+            self.dirty_servers.add(server.id)
+            self.publish("servers")
+            await self.nginx_reloader.reload()
 
     async def stop_server(self, uuid: str, reload_nginx: bool = True) -> None:
         del self.servers[uuid]
+        self.dirty_servers.add(uuid)
         logger.info(f"Stopping server: {uuid}")
-        await self.write_nginx_conf()
+        self.publish("servers")
         if reload_nginx:
-            await run_process("nginx -s reload")
+            await self.nginx_reloader.reload()
+        else:
+            await self.write_nginx_conf()
 
-    async def create_environment(self, environment_yaml: str) -> None:
+    async def create_environment(
+        self, environment_yaml: str, priority: int = 0
+    ) -> None:
         environment_dict = load(environment_yaml, Loader=Loader)
         env_name = environment_dict["name"]
+        check_environment_name(env_name)
         env_path = Path("environments") / env_name
         if await env_path.exists():
             logger.info(f"Environment already exists: {env_name}")
@@ -105,122 +465,795 @@ class Hub:
 
         logger.info(f"Creating environment: {env_name}")
         self.containers[env_name] = container = self.Container(
-            create_time=0, definition=environment_dict, path=env_path
+            create_time=time.time(), definition=environment_dict, path=env_path
+        )
+        self.publish("environments")
+        definition_hash = container.definition_hash
+        await self.build_scheduler.submit(
+            env_name,
+            partial(self._create_environment, container),
+            definition_hash,
+            priority,
+            # cloning an already built environment doesn't need to wait
+            queue=definition_hash not in self.build_cache,
         )
-        self.task_group.start_soon(self._create_environment, container)
 
-    async def _creation_timer(self, container: Container) -> None:
-        while True:
-            await sleep(1)
-            assert container.create_time is not None
-            container.create_time += 1
+    async def cancel_environment(self, env_name: str) -> None:
+        await self.build_scheduler.cancel(env_name)
+        container = self.containers.get(env_name)
+        if container is not None and container.create_time is not None:
+            await self._discard_environment(container)
 
-    async def _create_environment(self, container: Container) -> None:
-        async with create_task_group() as tg:
-            tg.start_soon(self._creation_timer, container)
-            await container.create_environment()
+    async def _discard_environment(self, container: Container) -> None:
+        assert container.path is not None
+        logger.info(f"Discarding environment: {container.path.name}")
+        self.containers.pop(container.path.name, None)
+        self.publish(f"environment-{container.path.name}")
+        with CancelScope(shield=True):
+            await to_thread.run_sync(shutil.rmtree, container.path, True)
+
+    def _publish_builds(self) -> None:
+        # the position of every queued build can change
+        for env_name in self.build_scheduler.builds:
+            self.publish(f"environment-{env_name}")
+
+    async def _create_environment(
+        self, container: Container, clone: bool = True
+    ) -> None:
+        assert container.path is not None
+        env_name = container.path.name
+        with span("create_environment", environment=env_name) as build_span:
+            start = time.perf_counter()
+            try:
+                method = "clone"
+                if not clone or not await self._clone_environment(container):
+                    # a clone doesn't wait in the queue, but creating it does
+                    method = "requeue"
+                    if await self.build_scheduler.requeue(
+                        env_name, partial(self._create_environment, container, False)
+                    ):
+                        return
+                    lock = await self._get_lock(container)
+                    method = "solve" if lock is None else "lock"
+                    await container.create_environment(self.config, lock)
+            except Exception:
+                await self._discard_environment(container)
+                raise
+            finally:
+                build_span.attributes["method"] = method
             container.create_time = None
-            tg.cancel_scope.cancel()
+            BUILD_DURATION.observe(time.perf_counter() - start, method)
+            self.publish(f"environment-{container.path.name}")
+            self.add_to_build_cache(container.path.name)
+            self.update_environment_nginx_conf(container.path.name)
+            self.warm_pool.fill(container.path.name)
+
+    async def _clone_environment(self, container: Container) -> bool:
+        definition_hash = container.definition_hash
+        if definition_hash not in self.build_cache:
+            return False
+
+        assert container.path is not None
+        env_name = container.path.name
+        # the longest name, as a process environment can only be cloned into a prefix
+        # that is not longer
+        source_name = max(
+            (
+                name
+                for name, source in self.containers.items()
+                if name != env_name
+                and source.create_time is None
+                and source.definition_hash == definition_hash
+            ),
+            key=len,
+            default=self.build_cache[definition_hash],
+        )
+        logger.info(f'Cloning environment "{env_name}" from "{source_name}"')
+        try:
+            with span("clone_environment", source=source_name):
+                await container.clone_environment(self.containers[source_name])
+        except Exception as exception:
+            logger.warning(
+                f'Could not clone environment "{env_name}", creating it',
+                exception=str(exception),
+            )
+            await to_thread.run_sync(shutil.rmtree, container.path, True)
+            return False
+        return True
+
+    async def _get_lock(self, container: Container) -> str | None:
+        # an environment with the same definition was already solved
+        source_name = self.build_cache.get(container.definition_hash or "")
+        if source_name is None:
+            return None
+
+        source_path = self.containers[source_name].path
+        assert source_path is not None
+        with span("load_lock", source=source_name):
+            return await load_lock(source_path)
+
+    def add_to_build_cache(self, env_name: str) -> None:
+        definition_hash = self.containers[env_name].definition_hash
+        if definition_hash is not None:
+            self.build_cache.setdefault(definition_hash, env_name)
+
+    def remove_from_build_cache(self, env_name: str) -> None:
+        definition_hash = self.containers[env_name].definition_hash
+        if definition_hash is None or self.build_cache.get(definition_hash) != env_name:
+            return
+
+        del self.build_cache[definition_hash]
+        for name, container in self.containers.items():
+            if (
+                name != env_name
+                and container.create_time is None
+                and container.definition_hash == definition_hash
+            ):
+                self.build_cache[definition_hash] = name
+                break
+
+    def server_lock(self, env_name: str) -> Lock:
+        # servers of different environments can start in parallel, and concurrent
+        # starts of the same environment's server wait for the first one
+        return self.server_locks.setdefault(env_name, Lock())
 
     async def start_container_server(self, env_name: str) -> None:
-        async with self.server_lock:
-            container = self.containers[env_name]
-            if container.process is not None:
+        with span("start_container_server", environment=env_name):
+            async with self.server_lock(env_name):
+                container = self.containers[env_name]
+                if container.process is not None:
+                    return
+
+                start = time.perf_counter()
+                source = "warm_pool"
+                environment_servers = []
+                environment_server = self.warm_pool.take(env_name)
+                if environment_server is None:
+                    source = "launch"
+                else:
+                    environment_servers.append(environment_server)
+                # all its servers start at the same time, the environment runs if any
+                # of them does
+                errors = await self._launch_container_servers(
+                    env_name,
+                    max(self.config.replicas, 1) - len(environment_servers),
+                    environment_servers,
+                )
+                if not environment_servers:
+                    raise errors[0]
+
+                for exception in errors:
+                    logger.warning(
+                        f'Could not start all the servers for environment "{env_name}"',
+                        exception=repr(exception),
+                    )
+                SERVER_START_DURATION.observe(time.perf_counter() - start, source)
+                environment_server, *replicas = environment_servers
+                if environment_server.routes != container.routes:
+                    # known routes let the environment be added without starting its server
+                    assert container.path is not None
+                    await save_routes(container.path, environment_server.routes)
+                container.routes = environment_server.routes
+                container.port = environment_server.port
+                container.socket = environment_server.socket
+                container.host = environment_server.host
+                container.process = environment_server.process
+                container.last_activity = time.time()
+                self.replicas[env_name] = replicas
+                # none of its servers has kernels yet
+                for uuid, server in self.servers.items():
+                    if env_name in server.environments:
+                        self.pin_replica(uuid, env_name)
+                self.update_environment_nginx_conf(env_name)
+
+    async def _launch_container_servers(
+        self,
+        env_name: str,
+        number: int,
+        environment_servers: list[EnvironmentServer],
+    ) -> list[Exception]:
+        # the servers that start are added to the list, the errors of the others are
+        # returned
+        errors = []
+
+        async def launch() -> None:
+            try:
+                environment_servers.append(
+                    await self._launch_container_server(env_name)
+                )
+            except Exception as exception:
+                errors.append(exception)
+
+        try:
+            async with create_task_group() as tg:
+                for _ in range(number):
+                    tg.start_soon(launch)
+        except BaseException:
+            with CancelScope(shield=True):
+                for environment_server in environment_servers:
+                    await self._stop_environment_server(environment_server)
+            raise
+        return errors
+
+    async def add_container_replica(self, env_name: str) -> None:
+        # another server for a running environment, for the servers that the
+        # environment is added to from now on
+        with span("add_container_replica", environment=env_name):
+            try:
+                environment_server = self.warm_pool.take(env_name)
+                if environment_server is None:
+                    environment_server = await self._launch_container_server(env_name)
+            except Exception as exception:
+                logger.warning(
+                    f'Could not start another server for environment "{env_name}"',
+                    exception=repr(exception),
+                )
+                return
+            finally:
+                self.launching_replicas[env_name] -= 1
+            async with self.server_lock(env_name):
+                container = self.containers.get(env_name)
+                running = container is not None and container.process is not None
+                if running:
+                    self.replicas[env_name].append(environment_server)
+                    self.update_environment_nginx_conf(env_name)
+            if not running:
+                # the environment's server was stopped in the meantime
+                await self._stop_environment_server(environment_server)
                 return
 
-            logger.info(f'Starting server for environment "{env_name}": {container.id}')
-            port = get_unused_tcp_ports(1)[0]
-            cmd = container.get_server_command(port)
-            process = await open_process(cmd, stdout=None, stderr=None)
-            async with httpx.AsyncClient() as client:
-                while True:
-                    await sleep(0.1)
-                    try:
-                        response = await client.get(f"http://127.0.0.1:{port}/routes")
-                        break
-                    except Exception:
-                        pass
-            container.routes = response.json()
-            container.port = port
-            container.process = process
+            logger.info(
+                f'Added server for environment "{env_name}": '
+                f"{len(self.replicas[env_name]) + 1} servers"
+            )
+            await self.nginx_reloader.reload()
+
+    async def remove_container_replica(
+        self, env_name: str, environment_server: EnvironmentServer
+    ) -> None:
+        async with self.server_lock(env_name):
+            replicas = self.replicas.get(env_name, [])
+            if environment_server not in replicas:
+                return
+
+            replicas.remove(environment_server)
+            # the servers that used it go to the environment's first server
+            for server in self.servers.values():
+                if server.replicas.get(env_name) == environment_server.port:
+                    del server.replicas[env_name]
+            self.update_environment_nginx_conf(env_name)
+        logger.info(
+            f'Removing server for environment "{env_name}": {len(replicas) + 1} servers'
+        )
+        # NGINX doesn't send requests to it anymore before it stops
+        await self.nginx_reloader.reload()
+        await self._stop_environment_server(environment_server)
+
+    def pin_replica(self, uuid: str, env_name: str) -> None:
+        # the requests of a server go to the least used server of the environment,
+        # where its kernels will be
+        container = self.containers[env_name]
+        replicas = self.replicas.get(env_name)
+        server = self.servers[uuid]
+        if container.port is None or not replicas:
+            server.replicas.pop(env_name, None)
+            return
+
+        usage = {container.port: 0}
+        usage.update((environment_server.port, 0) for environment_server in replicas)
+        for other_uuid, other in self.servers.items():
+            if other_uuid != uuid and env_name in other.environments:
+                port = other.replicas.get(env_name, container.port)
+                if port in usage:
+                    usage[port] += 1
+        port = min(usage, key=usage.__getitem__)
+        if port == container.port:
+            server.replicas.pop(env_name, None)
+        else:
+            server.replicas[env_name] = port
+
+    def get_server_addresses(
+        self, env_name: str
+    ) -> list[tuple[int, str | None, str | None]]:
+        # the port, socket and host of the running servers of an environment
+        container = self.containers[env_name]
+        if container.port is None:
+            return []
+        return [(container.port, container.socket, container.host)] + [
+            (
+                environment_server.port,
+                environment_server.socket,
+                environment_server.host,
+            )
+            for environment_server in self.replicas.get(env_name, [])
+        ]
+
+    async def _launch_container_server(self, env_name: str) -> EnvironmentServer:
+        container = self.containers[env_name]
+        logger.info(f'Starting server for environment "{env_name}": {container.id}')
+        with span("reserve_address"):
+            port = self.ports.reserve()
+            socket = None
+            if self.config.server_transport == "unix":
+                # NGINX cannot use the path that the server listens on, which has a colon
+                await self.socket_dir.mkdir(parents=True, exist_ok=True)
+                socket_path = self.socket_dir / f"{port}.sock"
+                await socket_path.unlink(missing_ok=True)
+                await socket_path.symlink_to(f"{socket_path}:{port}")
+                socket = str(socket_path)
+        try:
+            with span("start_server"):
+                process = await container.start_server(port, self.config, socket)
+        except BaseException:
+            await self._release_address(port, socket)
+            raise
+        host = container.get_server_host(process)
+        try:
+            with span("wait_for_routes"), fail_after(self.config.server_start_timeout):
+                routes = await self._get_routes(process, port, socket, host)
+        except BaseException:
+            logger.error(f'Could not start server for environment "{env_name}"')
+            with CancelScope(shield=True):
+                await container.kill_server(process)
+                await self._release_address(port, socket)
+            raise
+        return EnvironmentServer(container, process, port, routes, socket, host)
+
+    async def _stop_environment_server(
+        self, environment_server: EnvironmentServer
+    ) -> None:
+        with SERVER_STOP_DURATION.time():
+            await environment_server.container.stop_server(environment_server.process)
+        await self._release_address(environment_server.port, environment_server.socket)
+
+    async def _release_address(self, port: int, socket: str | None) -> None:
+        self.ports.release(port)
+        if socket is not None:
+            await Path(socket).unlink(missing_ok=True)
+            await Path(f"{socket}:{port}").unlink(missing_ok=True)
+
+    async def _get_routes(
+        self, process: Process, port: int, socket: str | None, host: str | None
+    ) -> list[dict[str, Any]]:
+        async with get_http_client(socket) as client:
+            while True:
+                await sleep(0.1)
+                if process.returncode is not None:
+                    raise RuntimeError(
+                        f"Server exited with return code {process.returncode}"
+                    )
+                try:
+                    response = await client.get(
+                        f"http://{host or '127.0.0.1'}:{port}/routes"
+                    )
+                except httpx.TransportError:
+                    continue
+
+                # the server may not be ready, or the port be another service's
+                if response.is_success:
+                    return response.json()
 
     async def add_server_environment(self, uuid: str, env_name: str) -> None:
-        if env_name in self.containers:
-            logger.info(f'Adding environment "{env_name}" in server: {uuid}')
-            server = self.servers[uuid]
-            server.environments.add(env_name)
-            await self.start_container_server(env_name)
-            server.create_nginx_conf(self.containers)
-            await self.write_nginx_conf()
-            await run_process("nginx -s reload")
+        await self.add_server_environments(uuid, [env_name])
+
+    async def add_server_environments(self, uuid: str, env_names: list[str]) -> None:
+        with span("add_server_environments", server=uuid):
+            added = []
+
+            async def start(env_name: str) -> None:
+                try:
+                    await self.start_container_server(env_name)
+                except Exception as exception:
+                    logger.error(
+                        f'Not adding environment "{env_name}" in server: {uuid}',
+                        exception=repr(exception),
+                    )
+                else:
+                    added.append(env_name)
+
+            # the servers of all the environments start at the same time
+            async with create_task_group() as tg:
+                for env_name in dict.fromkeys(env_names):
+                    container = self.containers.get(env_name)
+                    if container is None or container.create_time is not None:
+                        continue
+
+                    if self.config.lazy_start and container.routes:
+                        # the server starts on the first request, through the fallback
+                        added.append(env_name)
+                    else:
+                        tg.start_soon(start, env_name)
+            server = self.servers.get(uuid)
+            if server is None or not added:
+                return
+
+            for env_name in added:
+                logger.info(f'Adding environment "{env_name}" in server: {uuid}')
+                server.environments.add(env_name)
+                self.pin_replica(uuid, env_name)
+            self.update_server_nginx_conf(uuid)
+            self.publish(f"server-{uuid}")
+            await self.nginx_reloader.reload()
 
     async def remove_server_environment(self, uuid: str, env_name: str) -> None:
         logger.info(f'Removing environment "{env_name}" in server: {uuid}')
         server = self.servers[uuid]
         server.environments.remove(env_name)
-        server.create_nginx_conf(self.containers)
-        await self.write_nginx_conf()
-        await run_process("nginx -s reload")
+        server.replicas.pop(env_name, None)
+        self.update_server_nginx_conf(uuid)
+        self.publish(f"server-{uuid}")
+        await self.nginx_reloader.reload()
 
     async def stop_container_server(
         self, env_name: str, reload_nginx: bool = True
     ) -> None:
-        container = self.containers[env_name]
-        if container.process is None:
-            return
+        with span("stop_container_server", environment=env_name):
+            async with self.server_lock(env_name):
+                container = self.containers[env_name]
+                if container.process is None:
+                    return
 
-        logger.info(f"Stopping server for environment: {env_name}")
-        process = psutil.Process(container.process.pid)
-        children = process.children(recursive=True)
-        if children:
-            os.kill(children[0].pid, signal.SIGINT)
-        await container.process.wait()
-        container.process = None
-        container.port = None
-        await self.write_nginx_conf()
-        if reload_nginx:
-            await run_process("nginx -s reload")
+                logger.info(f"Stopping server for environment: {env_name}")
+                async with create_task_group() as tg:
+                    for environment_server in self.replicas.pop(env_name, []):
+                        tg.start_soon(self._stop_environment_server, environment_server)
+                    with span("stop_server"), SERVER_STOP_DURATION.time():
+                        await container.stop_server(container.process)
+                if container.port is not None:
+                    await self._release_address(container.port, container.socket)
+                container.process = None
+                container.port = None
+                container.socket = None
+                container.host = None
+                for server in self.servers.values():
+                    server.replicas.pop(env_name, None)
+                self.update_environment_nginx_conf(env_name)
+            if reload_nginx:
+                await self.nginx_reloader.reload()
+            else:
+                await self.write_nginx_conf()
 
     async def delete_environment(self, env_name: str) -> None:
         for uuid, server in self.servers.items():
             if env_name in server.environments:
                 logger.info(f'Removing environment "{env_name}" in server: {uuid}')
                 server.environments.remove(env_name)
-                server.create_nginx_conf(self.containers)
+                server.replicas.pop(env_name, None)
+                self.update_server_nginx_conf(uuid)
+                self.publish(f"server-{uuid}")
         await self.stop_container_server(env_name)
+        await self.warm_pool.drain(env_name)
         logger.info(f"Deleting environment: {env_name}")
-        del self.containers[env_name]
+        self.remove_from_build_cache(env_name)
+        container = self.containers.pop(env_name)
+        self.server_locks.pop(env_name, None)
+        # its include files are removed, even without a running server (its fallback)
+        self.dirty_environments.add(env_name)
+        self.publish(f"environment-{env_name}")
+        await container.delete_environment(self.config)
         env_dir = Path("environments") / env_name
         await to_thread.run_sync(shutil.rmtree, env_dir)
-        await self.write_nginx_conf()
-        await run_process("nginx -s reload")
+        await self.nginx_reloader.reload()
 
-    async def write_nginx_conf(self) -> None:
+    async def wake_container_server(self, env_name: str) -> None:
+        # a request came for an environment whose server is not running
+        with span("wake_container_server", environment=env_name):
+            container = self.containers[env_name]
+            if (
+                container.process is not None
+                and container.process.returncode is not None
+            ):
+                logger.warning(f"Server for environment exited: {env_name}")
+                await self.stop_container_server(env_name, False)
+            for environment_server in list(self.replicas.get(env_name, [])):
+                if environment_server.process.returncode is not None:
+                    logger.warning(f"Other server for environment exited: {env_name}")
+                    await self.remove_container_replica(env_name, environment_server)
+            await self.start_container_server(env_name)
+            await self.nginx_reloader.reload()
+
+    async def cull_container_servers(self) -> None:
+        connections_listed = True
+        while True:
+            await sleep(self.config.cull_interval)
+            activity = await self.activity_log.read()
+            running = {
+                env_name: container
+                for env_name, container in self.containers.items()
+                if container.port is not None
+            }
+            # an environment is used if any of its servers is
+            ports = {
+                env_name: {port for port, _, _ in self.get_server_addresses(env_name)}
+                for env_name in running
+            }
+            connected_ports = await to_thread.run_sync(
+                get_connected_ports,
+                {port for env_ports in ports.values() for port in env_ports},
+            )
+            now = time.time()
+            idle = []
+            for env_name, container in running.items():
+                for port in ports[env_name] & activity.keys():
+                    container.last_activity = max(
+                        container.last_activity or 0, activity[port]
+                    )
+                if connected_ports is None:
+                    continue
+
+                if ports[env_name] & connected_ports:
+                    container.last_activity = now
+                else:
+                    idle.append(env_name)
+            if connected_ports is None:
+                # a server with an open WebSocket would look idle
+                if connections_listed:
+                    logger.warning(
+                        "Could not list the connections to the environment servers, "
+                        "not culling them"
+                    )
+                connections_listed = False
+                continue
+
+            connections_listed = True
+
+            # least recently used first
+            idle.sort(key=lambda env_name: running[env_name].last_activity or 0)
+
+            idle_timeout = self.config.cull_idle_timeout
+            if idle_timeout:
+                async with create_task_group() as tg:
+                    for env_name in list(idle):
+                        if now - (running[env_name].last_activity or 0) > idle_timeout:
+                            logger.info(
+                                f"Culling idle server for environment: {env_name}"
+                            )
+                            tg.start_soon(self.stop_container_server, env_name)
+                            idle.remove(env_name)
+
+            memory_percent = self.config.cull_memory_percent
+            while (
+                memory_percent
+                and idle
+                and psutil.virtual_memory().percent > memory_percent
+            ):
+                env_name = idle.pop(0)
+                if env_name in self.containers:
+                    logger.info(
+                        f"Culling least recently used server for environment: {env_name}"
+                    )
+                    await self.stop_container_server(env_name)
+
+    async def scale_container_servers(self) -> None:
+        # replace the servers that exited, and follow the CPU usage of the
+        # environments between the configured numbers of servers
+        autoscaling = self.config.max_replicas > self.config.replicas
+        cpu_times: dict[int, float] = {}
+        sample_time = time.monotonic()
+        while True:
+            await sleep(self.config.replica_scale_interval)
+            # not the ones whose servers are starting or stopping
+            running = {
+                env_name: container
+                for env_name, container in self.containers.items()
+                if container.process is not None
+                and not self.server_lock(env_name).locked()
+            }
+            for env_name in running:
+                for environment_server in list(self.replicas.get(env_name, [])):
+                    if environment_server.process.returncode is not None:
+                        logger.warning(
+                            f"Other server for environment exited: {env_name}"
+                        )
+                        self.task_group.start_soon(
+                            self.remove_container_replica, env_name, environment_server
+                        )
+            processes = {
+                env_name: [
+                    process
+                    for process in [
+                        container.process,
+                        *(
+                            environment_server.process
+                            for environment_server in self.replicas.get(env_name, [])
+                        ),
+                    ]
+                    if process is not None and process.returncode is None
+                ]
+                for env_name, container in running.items()
+            }
+            resources = {}
+            if autoscaling:
+                # not local processes have no PID
+                pids = {
+                    process.pid
+                    for env_processes in processes.values()
+                    for process in env_processes
+                    if process.pid > 0
+                }
+                resources = await to_thread.run_sync(get_process_resources, pids)
+            now = time.monotonic()
+            elapsed, sample_time = now - sample_time, now
+            for env_name, env_processes in processes.items():
+                number = len(env_processes) + self.launching_replicas[env_name]
+                cpu_percents = [
+                    (resources[process.pid][1] - cpu_times.get(process.pid, 0))
+                    / elapsed
+                    * 100
+                    for process in env_processes
+                    if process.pid in cpu_times and process.pid in resources
+                ]
+                cpu_percent = (
+                    sum(cpu_percents) / len(cpu_percents) if cpu_percents else 0
+                )
+                if number < self.config.replicas or (
+                    autoscaling
+                    and cpu_percent > self.config.replica_cpu_percent
+                    and number < self.config.max_replicas
+                ):
+                    self.launching_replicas[env_name] += 1
+                    self.task_group.start_soon(self.add_container_replica, env_name)
+                elif (
+                    autoscaling
+                    and cpu_percent < self.config.replica_cpu_percent / 3
+                    and number > self.config.replicas
+                ):
+                    # one that no server uses, as stopping it would stop their kernels
+                    used_ports = {
+                        server.replicas[env_name]
+                        for server in self.servers.values()
+                        if env_name in server.replicas
+                    }
+                    for environment_server in reversed(self.replicas[env_name]):
+                        if environment_server.port not in used_ports:
+                            self.task_group.start_soon(
+                                self.remove_container_replica,
+                                env_name,
+                                environment_server,
+                            )
+                            break
+            cpu_times = {pid: cpu_time for pid, (_, cpu_time) in resources.items()}
+
+    def update_environment_nginx_conf(self, env_name: str) -> None:
+        container = self.containers[env_name]
+        container.nginx_upstream_conf = "".join(
+            process_upstream(port, socket, host, self.config.nginx_keepalive)
+            for port, socket, host in self.get_server_addresses(env_name)
+        )
+        nginx_confs = [
+            process_fallback(container.fallback, env_name, self.macroverse_port)
+        ]
+        if self.config.nginx_routing == "prefix":
+            nginx_confs.append(
+                process_prefix(
+                    container.upstream, str(container.id), container.fallback
+                )
+            )
+        elif container.routes:
+            nginx_confs.append(
+                process_routes(
+                    container.routes,
+                    container.upstream,
+                    str(container.id),
+                    fallback=container.fallback,
+                )
+            )
+        container.nginx_conf = "".join(nginx_confs)
+        self.dirty_environments.add(env_name)
+        # the servers using the environment point to it or to its fallback
+        for uuid, server in self.servers.items():
+            if env_name in server.environments:
+                self.update_server_nginx_conf(uuid)
+
+    def update_server_nginx_conf(self, uuid: str) -> None:
+        self.servers[uuid].create_nginx_conf(self.containers)
+        self.dirty_servers.add(uuid)
+
+    async def write_nginx_main_conf(self) -> None:
         async with self.nginx_lock:
-            nginx_conf = [
-                NGINX_CONF.format(
-                    nginx_port=self.nginx_port, macroverse_port=self.macroverse_port
+            # the cached assets may be the ones of a previous version of jupyverse,
+            # which are only served by this process
+            await to_thread.run_sync(shutil.rmtree, self.nginx_cache_dir, True)
+            # NGINX only creates the last directory of a cache path
+            await self.nginx_cache_dir.mkdir(parents=True, exist_ok=True)
+            # start from a clean include directory, with what is known at startup
+            await self.nginx_include_dir.mkdir(parents=True, exist_ok=True)
+            async for path in self.nginx_include_dir.iterdir():
+                await path.unlink()
+            self.dirty_servers.update(self.servers)
+            self.dirty_environments.update(self.containers)
+            activity_log = ""
+            if self.culling:
+                await self.activity_log.path.parent.mkdir(parents=True, exist_ok=True)
+                activity_log = (
+                    f"    access_log {self.activity_log.path} macroverse_activity;\n"
                 )
-            ]
-            for uuid, server in self.servers.items():
-                nginx_conf.append(server.nginx_conf)
-            nginx_conf.append("}")
-            nginx_conf_str = "".join(nginx_conf)
-            await self.nginx_conf_path.write_text(nginx_conf_str)
+            nginx_conf_str = NGINX_CONF.format(
+                nginx_port=self.nginx_port,
+                macroverse_port=self.macroverse_port,
+                include_dir=self.nginx_include_dir,
+                static_dir=self.static_dir,
+                cache_dir=self.nginx_cache_dir,
+                activity_log=activity_log,
+            )
+            await atomic_write_text(self.nginx_conf_path, nginx_conf_str)
+        await self.write_nginx_conf()
+
+    async def write_nginx_conf(self) -> None:
+        # only the include files of what changed are written
+        with span("write_nginx_conf"):
+            async with self.nginx_lock:
+                with NGINX_WRITE_DURATION.time():
+                    dirty_servers, self.dirty_servers = self.dirty_servers, set()
+                    dirty_environments, self.dirty_environments = (
+                        self.dirty_environments,
+                        set(),
+                    )
+                    for uuid in dirty_servers:
+                        server = self.servers.get(uuid)
+                        await self._write_nginx_include(
+                            f"server-{uuid}.conf",
+                            None if server is None else server.nginx_conf,
+                        )
+                    for env_name in dirty_environments:
+                        container = self.containers.get(env_name)
+                        await self._write_nginx_include(
+                            f"environment-{env_name}.conf",
+                            None if container is None else container.nginx_conf,
+                        )
+                        # the upstreams that its locations proxy to, if it runs
+                        await self._write_nginx_include(
+                            f"environment-{env_name}.upstream",
+                            None
+                            if container is None
+                            else container.nginx_upstream_conf,
+                        )
+                if self.config.persist_state:
+                    # the state that the configuration reflects
+                    await self.save_state()
+
+    async def _write_nginx_include(self, name: str, nginx_conf: str | None) -> None:
+        path = self.nginx_include_dir / name
+        if nginx_conf is None:
+            await path.unlink(missing_ok=True)
+        else:
+            await atomic_write_text(path, nginx_conf)
 
 
 NGINX_CONF = """\
+# without an upgrade, the connections to the environment servers are kept open
 map $http_upgrade $connection_upgrade {{
     default upgrade;
-    ''      close;
+    ''      '';
+}}
+
+log_format macroverse_activity '$msec $upstream_addr';
+
+# JupyterLab assets, shared by all servers
+proxy_cache_path {cache_dir} levels=1:2 keys_zone=macroverse_static:10m max_size=1g inactive=7d use_temp_path=off;
+
+# versioned or content-hashed assets never change
+map $request_uri $macroverse_static_cache_control {{
+    default "public, max-age=3600";
+    "~[?&]v="  "public, max-age=31536000, immutable";
+    "~[.][0-9a-f]{{16,}}[.](js|css)([?]|$)" "public, max-age=31536000, immutable";
 }}
 
+# environment servers
+include {include_dir}/*.upstream;
+
 server {{
     # nginx at {nginx_port}
 
     listen       {nginx_port};
     server_name  localhost;
 
+    gzip on;
+    gzip_types text/css application/javascript text/javascript application/json image/svg+xml;
+    gzip_min_length 1024;
+    gzip_proxied any;
+    gzip_vary on;
+{activity_log}
     # macroverse at {macroverse_port}
 
     location = / {{
@@ -231,4 +1264,16 @@ server {{
     location /macroverse {{
         proxy_pass http://localhost:{macroverse_port};
     }}
+
+    location /macroverse/static/ {{
+        alias {static_dir}/;
+        gzip_static on;
+        # the file names change with their content
+        add_header Cache-Control "public, max-age=31536000, immutable";
+    }}
+
+    # servers and environments
+
+    include {include_dir}/*.conf;
+}}
 """
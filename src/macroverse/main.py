@@ -12,7 +12,9 @@ from jupyverse_api.lab import PageConfig
 from fastapi import FastAPI
 from structlog import get_logger
 
+from .config import Config
 from .hub import ContainerType, Hub
+from .state import load_state
 from .ui.main import macroverse_app
 from .utils import get_unused_tcp_ports
 
@@ -25,14 +27,24 @@ class MacroverseModule(Module):
         self,
         container: ContainerType,
         open_browser: bool,
+        config: Config | None = None,
     ):
         super().__init__(
             "macroverse", prepare_timeout=10, start_timeout=10, stop_timeout=10
         )
         self.container = container
         self.open_browser = open_browser
+        self.config = Config() if config is None else config
         self.host = "localhost"
-        self.nginx_port, self.macroverse_port = get_unused_tcp_ports(2)
+        state = load_state() if self.config.persist_state else None
+        if state is None:
+            self.nginx_port, self.macroverse_port = get_unused_tcp_ports(2)
+        else:
+            # the URLs must not change for the users
+            self.nginx_port, self.macroverse_port = (
+                state.nginx_port,
+                state.macroverse_port,
+            )
         self.add_module("fps.web.fastapi:FastAPIModule", "fastapi")
         self.add_module(
             "fps.web.server:ServerModule",
@@ -45,7 +57,9 @@ class MacroverseModule(Module):
         async with create_task_group() as tg:
             root_app = await self.get(FastAPI)
             root_app.mount("/macroverse", macroverse_app)
-            self.hub = Hub(tg, self.nginx_port, self.macroverse_port, self.container)
+            self.hub = Hub(
+                tg, self.nginx_port, self.macroverse_port, self.container, self.config
+            )
 
             @macroverse_app.middleware("http")
             async def put_hub(
@@ -0,0 +1,172 @@
+import time
+from collections.abc import Generator, Iterable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import psutil
+
+
+# in the Prometheus text format, without a client library
+DEFAULT_BUCKETS = (
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+    600.0,
+    1800.0,
+)
+Labels = dict[str, str]
+
+
+@dataclass
+class _HistogramValue:
+    # the counts are cumulative, like the Prometheus buckets
+    bucket_counts: list[int]
+    sum: float = 0
+    count: int = 0
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values: dict[tuple[str, ...], _HistogramValue] = {}
+        HISTOGRAMS.append(self)
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        if labelvalues not in self.values:
+            self.values[labelvalues] = _HistogramValue([0] * len(self.buckets))
+        histogram_value = self.values[labelvalues]
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                histogram_value.bucket_counts[i] += 1
+        histogram_value.sum += value
+        histogram_value.count += 1
+
+    @contextmanager
+    def time(self, *labelvalues: str) -> Generator[None]:
+        # what fails is not observed
+        start = time.perf_counter()
+        yield
+        self.observe(time.perf_counter() - start, *labelvalues)
+
+    def collect(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labelvalues, value in sorted(self.values.items()):
+            labels = dict(zip(self.labelnames, labelvalues))
+            for bucket, bucket_count in zip(self.buckets, value.bucket_counts):
+                bucket_labels = format_labels({**labels, "le": str(bucket)})
+                yield f"{self.name}_bucket{bucket_labels} {bucket_count}"
+            bucket_labels = format_labels({**labels, "le": "+Inf"})
+            yield f"{self.name}_bucket{bucket_labels} {value.count}"
+            yield f"{self.name}_sum{format_labels(labels)} {value.sum}"
+            yield f"{self.name}_count{format_labels(labels)} {value.count}"
+
+
+HISTOGRAMS: list[Histogram] = []
+
+BUILD_DURATION = Histogram(
+    "macroverse_environment_build_seconds",
+    "Time to create an environment.",
+    ("method",),
+)
+SERVER_START_DURATION = Histogram(
+    "macroverse_environment_server_start_seconds",
+    "Time for an environment server to be ready.",
+    ("source",),
+)
+SERVER_STOP_DURATION = Histogram(
+    "macroverse_environment_server_stop_seconds",
+    "Time to stop an environment server.",
+)
+NGINX_WRITE_DURATION = Histogram(
+    "macroverse_nginx_write_seconds",
+    "Time to write the NGINX configuration.",
+)
+NGINX_RELOAD_DURATION = Histogram(
+    "macroverse_nginx_reload_seconds",
+    "Time to reload NGINX.",
+)
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_metric(
+    name: str,
+    documentation: str,
+    metric_type: str,
+    samples: Iterable[tuple[Labels, float]],
+) -> Iterator[str]:
+    yield f"# HELP {name} {documentation}"
+    yield f"# TYPE {name} {metric_type}"
+    for labels, value in samples:
+        yield f"{name}{format_labels(labels)} {value}"
+
+
+def collect_histograms() -> Iterator[str]:
+    for histogram in HISTOGRAMS:
+        yield from histogram.collect()
+
+
+def get_process_resources(pids: Iterable[int]) -> dict[int, tuple[int, float]]:
+    # the memory (RSS) and CPU time of processes and their descendants (like kernels),
+    # from a single pass over all the processes
+    processes = {}
+    children: dict[int, list[int]] = {}
+    for process in psutil.process_iter(["ppid", "memory_info", "cpu_times"]):
+        info = process.info
+        if info["memory_info"] is None or info["cpu_times"] is None:
+            # access denied
+            continue
+
+        cpu_times = info["cpu_times"]
+        processes[process.pid] = (
+            info["memory_info"].rss,
+            cpu_times.user + cpu_times.system,
+        )
+        children.setdefault(info["ppid"], []).append(process.pid)
+
+    resources = {}
+    for pid in pids:
+        if pid not in processes:
+            continue
+
+        rss = 0
+        cpu = 0.0
+        stack = [pid]
+        while stack:
+            descendant = stack.pop()
+            if descendant in processes:
+                descendant_rss, descendant_cpu = processes[descendant]
+                rss += descendant_rss
+                cpu += descendant_cpu
+            stack.extend(children.get(descendant, []))
+        resources[pid] = (rss, cpu)
+    return resources
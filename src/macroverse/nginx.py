@@ -0,0 +1,69 @@
+from collections.abc import Awaitable, Callable
+
+import structlog
+from anyio import Event, run_process, sleep
+
+from .metrics import NGINX_RELOAD_DURATION
+from .tracing import span
+
+
+logger = structlog.get_logger()
+
+
+class _Batch:
+    def __init__(self) -> None:
+        self.requests = 0
+        self.applied = Event()
+        self.error: Exception | None = None
+
+
+class NginxReloader:
+    def __init__(self, write_conf: Callable[[], Awaitable[None]], delay: float) -> None:
+        self.write_conf = write_conf
+        self.delay = delay
+        self.reload_requests = 0
+        self.reloads = 0
+        self.reload_failures = 0
+        self._pending = Event()
+        self._batch = _Batch()
+
+    @property
+    def reloads_saved(self) -> int:
+        return (
+            self.reload_requests
+            - self._batch.requests
+            - self.reloads
+            - self.reload_failures
+        )
+
+    async def reload(self) -> None:
+        # returns once the configuration including the caller's changes is live
+        batch = self._batch
+        batch.requests += 1
+        self.reload_requests += 1
+        self._pending.set()
+        with span("wait_nginx_reload"):
+            await batch.applied.wait()
+        if batch.error is not None:
+            raise RuntimeError("Could not reload nginx") from batch.error
+
+    async def run(self) -> None:
+        while True:
+            await self._pending.wait()
+            # let the changes arriving in the meantime join this reload
+            await sleep(self.delay)
+            batch, self._batch = self._batch, _Batch()
+            self._pending = Event()
+            logger.info("Reloading nginx", requests=batch.requests)
+            try:
+                with span("nginx_reload", requests=batch.requests):
+                    await self.write_conf()
+                    with span("nginx -s reload"), NGINX_RELOAD_DURATION.time():
+                        await run_process("nginx -s reload")
+            except Exception as exception:
+                logger.error("Could not reload nginx", exception=str(exception))
+                batch.error = exception
+                self.reload_failures += 1
+            else:
+                self.reloads += 1
+            batch.applied.set()
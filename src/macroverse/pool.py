@@ -0,0 +1,115 @@
+from collections import defaultdict, deque
+from collections.abc import Awaitable, Callable, Coroutine
+from dataclasses import dataclass
+from time import monotonic
+from typing import Any
+
+import structlog
+from anyio import sleep
+from anyio.abc import Process, TaskGroup
+
+from .containers.base import Container
+
+
+logger = structlog.get_logger()
+
+
+@dataclass
+class EnvironmentServer:
+    container: Container
+    process: Process
+    port: int
+    routes: list[dict[str, Any]]
+    socket: str | None = None
+    host: str | None = None
+
+
+class WarmPool:
+    def __init__(
+        self,
+        task_group: TaskGroup,
+        launch: Callable[[str], Awaitable[EnvironmentServer]],
+        stop: Callable[[EnvironmentServer], Coroutine[Any, Any, None]],
+        size: int,
+        sizes: dict[str, int],
+        demand_window: float,
+    ) -> None:
+        self.task_group = task_group
+        self.launch = launch
+        self.stop = stop
+        self.size = size
+        self.sizes = sizes
+        self.demand_window = demand_window
+        self.servers: dict[str, list[EnvironmentServer]] = defaultdict(list)
+        self.launching: dict[str, int] = defaultdict(int)
+        self.demand: dict[str, deque[float]] = defaultdict(deque)
+        self.generations: dict[str, int] = defaultdict(int)
+
+    def get_size(self, env_name: str) -> int:
+        size = self.sizes.get(env_name, self.size)
+        if size == 0:
+            return 0
+
+        demand = self.demand[env_name]
+        while demand and demand[0] < monotonic() - self.demand_window:
+            demand.popleft()
+        # keep one server ready, more if more were recently needed
+        return min(size, max(1, len(demand)))
+
+    def take(self, env_name: str) -> EnvironmentServer | None:
+        # the demand is not pruned without a pool
+        if self.sizes.get(env_name, self.size):
+            self.demand[env_name].append(monotonic())
+        servers = self.servers[env_name]
+        server = None
+        while servers:
+            server = servers.pop(0)
+            if server.process.returncode is None:
+                break
+            server = None
+        self.fill(env_name)
+        if server is not None:
+            logger.info(f'Taking server from warm pool for environment "{env_name}"')
+        return server
+
+    def fill(self, env_name: str) -> None:
+        servers = self.servers[env_name]
+        missing = self.get_size(env_name) - len(servers) - self.launching[env_name]
+        for _ in range(missing):
+            self.launching[env_name] += 1
+            self.task_group.start_soon(self._launch, env_name)
+        for _ in range(-missing):
+            if servers:
+                self.task_group.start_soon(self.stop, servers.pop())
+
+    async def _launch(self, env_name: str) -> None:
+        generation = self.generations[env_name]
+        try:
+            server = await self.launch(env_name)
+        except Exception as exception:
+            logger.warning(
+                f'Could not start server in warm pool for environment "{env_name}"',
+                exception=repr(exception),
+            )
+            return
+        finally:
+            self.launching[env_name] -= 1
+        if generation != self.generations[env_name]:
+            # the pool was drained in the meantime
+            await self.stop(server)
+        else:
+            self.servers[env_name].append(server)
+
+    async def drain(self, env_name: str) -> None:
+        self.generations[env_name] += 1
+        servers = self.servers.pop(env_name, [])
+        self.demand.pop(env_name, None)
+        for server in servers:
+            await self.stop(server)
+
+    async def run(self) -> None:
+        # shrink the pools whose demand went down
+        while True:
+            await sleep(60)
+            for env_name in list(self.servers):
+                self.fill(env_name)
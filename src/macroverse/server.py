@@ -2,18 +2,21 @@ from dataclasses import dataclass, field
 from uuid import uuid4
 
 from .containers.base import Container
-from .utils import process_routes
+from .utils import Routing, get_upstream, process_routes
 
 
 @dataclass
 class Server:
     macroverse_port: int
-    id: str = field(init=False)
+    routing: Routing = "prefix"
+    id: str = field(default_factory=lambda: str(uuid4()))
     environments: set[str] = field(default_factory=set)
+    # the port of the environment server that the requests of an environment go to,
+    # if not its first one, so that they always reach the same kernels
+    replicas: dict[str, int] = field(default_factory=dict)
     nginx_conf: str = field(init=False)
 
     def __post_init__(self):
-        self.id = str(uuid4())
         self.nginx_conf = NGINX_MAIN_JUPYVERSE_CONF.format(
             uuid=self.id, macroverse_port=self.macroverse_port
         )
@@ -26,12 +29,20 @@ class Server:
         ]
         for env_name in self.environments:
             container = containers[env_name]
-            assert container.port is not None
-            nginx_confs.append(
-                process_routes(container.routes, container.port, self.id)
-            )
+            if not container.routes:
+                continue
+
+            upstream = container.upstream
+            if upstream is not None and env_name in self.replicas:
+                upstream = get_upstream(self.replicas[env_name])
             nginx_confs.append(
-                process_routes(container.routes, container.port, str(container.id))
+                process_routes(
+                    container.routes,
+                    upstream,
+                    self.id,
+                    self.routing,
+                    container.fallback,
+                )
             )
         self.nginx_conf = "".join(nginx_confs)
 
@@ -48,4 +59,20 @@ NGINX_MAIN_JUPYVERSE_CONF = """
         proxy_set_header Upgrade $http_upgrade;
         proxy_set_header Connection $connection_upgrade;
     }}
+
+    # JupyterLab assets are the same for all servers, they are cached without the
+    # server ID in their key
+    location /jupyverse/{uuid}/static/ {{
+        rewrite ^/jupyverse/{uuid}/(.*)$ /jupyverse/$1 break;
+        proxy_pass http://localhost:{macroverse_port};
+        proxy_cache macroverse_static;
+        proxy_cache_key $uri$is_args$args;
+        proxy_cache_valid 200 7d;
+        proxy_cache_lock on;
+        proxy_ignore_headers Cache-Control Expires Set-Cookie;
+        proxy_hide_header Set-Cookie;
+        proxy_hide_header Cache-Control;
+        add_header Cache-Control $macroverse_static_cache_control;
+        add_header X-Cache-Status $upstream_cache_status;
+    }}
 """
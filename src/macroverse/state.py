@@ -0,0 +1,103 @@
+import json
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from signal import Signals
+
+import psutil
+import structlog
+from anyio import sleep
+
+from .containers.base import ExternalProcess
+
+
+# next to the "environments" directory
+STATE_PATH = "macroverse-state.json"
+logger = structlog.get_logger()
+
+
+@dataclass
+class EnvironmentServerState:
+    id: str
+    port: int
+    pid: int
+    create_time: float
+    socket: str | None = None
+
+
+@dataclass
+class HubState:
+    nginx_port: int
+    macroverse_port: int
+    servers: dict[str, list[str]] = field(default_factory=dict)
+    environment_servers: dict[str, EnvironmentServerState] = field(default_factory=dict)
+
+    def dumps(self) -> str:
+        return json.dumps(asdict(self), indent=2)
+
+
+def load_state(path: str = STATE_PATH) -> HubState | None:
+    state_path = Path(path)
+    if not state_path.exists():
+        return None
+
+    try:
+        state_dict = json.loads(state_path.read_text())
+        state = HubState(**state_dict)
+        state.environment_servers = {
+            env_name: EnvironmentServerState(**environment_server)
+            for env_name, environment_server in state_dict[
+                "environment_servers"
+            ].items()
+        }
+    except (json.JSONDecodeError, TypeError, KeyError) as exception:
+        # corrupt, or written by an incompatible version
+        logger.warning(f"Ignoring state file: {path}", exception=repr(exception))
+        return None
+    return state
+
+
+class ReattachedProcess(ExternalProcess):
+    # a process started by a previous macroverse, which is not our child anymore
+    def __init__(self, pid: int, create_time: float) -> None:
+        super().__init__()
+        self._process = psutil.Process(pid)
+        if self._process.create_time() != create_time:
+            # the PID was reused by another process
+            raise psutil.NoSuchProcess(pid)
+
+    async def wait(self) -> int:
+        while self.returncode is None:
+            await sleep(0.1)
+        return self.returncode
+
+    def terminate(self) -> None:
+        try:
+            self._process.terminate()
+        except psutil.NoSuchProcess:
+            pass
+
+    def kill(self) -> None:
+        try:
+            self._process.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+    def send_signal(self, signal: Signals) -> None:
+        try:
+            self._process.send_signal(signal)
+        except psutil.NoSuchProcess:
+            pass
+
+    @property
+    def pid(self) -> int:
+        return self._process.pid
+
+    @property
+    def returncode(self) -> int | None:
+        # the exit code of a process that is not our child cannot be known
+        try:
+            if self._process.status() != psutil.STATUS_ZOMBIE:
+                return None
+        except psutil.NoSuchProcess:
+            pass
+        return 0
@@ -0,0 +1,178 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from collections.abc import Generator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from typing import Any
+
+import httpx
+import structlog
+from anyio import (
+    WouldBlock,
+    create_memory_object_stream,
+    open_file,
+)
+
+
+logger = structlog.get_logger()
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    start: float
+    duration: float | None = None
+    attributes: dict[str, Any] = field(default_factory=dict)
+    error: str | None = None
+
+    def to_otlp(self) -> dict[str, Any]:
+        start = int(self.start * 1e9)
+        otlp_span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(start),
+            "endTimeUnixNano": str(start + int((self.duration or 0) * 1e9)),
+            "attributes": [
+                {"key": key, "value": {"stringValue": str(value)}}
+                for key, value in self.attributes.items()
+            ],
+            # STATUS_CODE_ERROR or STATUS_CODE_OK
+            "status": {"code": 1}
+            if self.error is None
+            else {"code": 2, "message": self.error},
+        }
+        if self.parent_id is not None:
+            otlp_span["parentSpanId"] = self.parent_id
+        return otlp_span
+
+
+_current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+
+class Tracer:
+    # spans are kept in memory by trace for the debug view, and exported if configured
+    def __init__(self, max_traces: int = 200, max_spans: int = 10_000) -> None:
+        self.max_traces = max_traces
+        self.traces: OrderedDict[str, list[Span]] = OrderedDict()
+        self.exporting = False
+        self._send_stream, self._receive_stream = create_memory_object_stream[Span](
+            max_spans
+        )
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Generator[Span]:
+        # nested in the current span, including across the tasks it starts
+        parent = _current_span.get()
+        span = Span(
+            name=name,
+            trace_id=os.urandom(16).hex() if parent is None else parent.trace_id,
+            span_id=os.urandom(8).hex(),
+            parent_id=None if parent is None else parent.span_id,
+            start=time.time(),
+            attributes=attributes,
+        )
+        token = _current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as exception:
+            span.error = repr(exception)
+            raise
+        finally:
+            span.duration = time.perf_counter() - start
+            _current_span.reset(token)
+            self._finish(span)
+
+    def _finish(self, span: Span) -> None:
+        if span.trace_id not in self.traces:
+            self.traces[span.trace_id] = []
+            if len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+        self.traces[span.trace_id].append(span)
+        if not self.exporting:
+            return
+
+        try:
+            self._send_stream.send_nowait(span)
+        except WouldBlock:
+            # the exporter doesn't keep up
+            pass
+
+    def get_slowest_traces(self, number: int = 20) -> list[tuple[Span, list[Span]]]:
+        # the finished operations, with all their spans
+        traces = []
+        for spans in self.traces.values():
+            roots = [span for span in spans if span.parent_id is None]
+            if roots:
+                traces.append((roots[0], spans))
+        traces.sort(key=lambda trace: trace[0].duration or 0, reverse=True)
+        return traces[:number]
+
+    async def run(self, trace_file: str, otlp_endpoint: str) -> None:
+        if not trace_file and not otlp_endpoint:
+            return
+
+        self.exporting = True
+        async with httpx.AsyncClient() as client:
+            async for span in self._receive_stream:
+                # spans are sent in batches
+                spans = [span]
+                while len(spans) < 512:
+                    try:
+                        spans.append(self._receive_stream.receive_nowait())
+                    except WouldBlock:
+                        break
+                try:
+                    if trace_file:
+                        await self._write(trace_file, spans)
+                    if otlp_endpoint:
+                        await self._send(client, otlp_endpoint, spans)
+                except Exception as exception:
+                    logger.warning(
+                        "Could not export tracing spans", exception=repr(exception)
+                    )
+
+    async def _write(self, trace_file: str, spans: list[Span]) -> None:
+        async with await open_file(trace_file, "a") as f:
+            await f.write(
+                "".join(json.dumps(asdict(span), default=str) + "\n" for span in spans)
+            )
+
+    async def _send(
+        self, client: httpx.AsyncClient, otlp_endpoint: str, spans: list[Span]
+    ) -> None:
+        # OTLP/HTTP with JSON encoding
+        body = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": "macroverse"},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "macroverse"},
+                            "spans": [span.to_otlp() for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        response = await client.post(otlp_endpoint, json=body)
+        response.raise_for_status()
+
+
+tracer = Tracer()
+span = tracer.span
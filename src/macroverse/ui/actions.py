@@ -1,14 +1,18 @@
+from fastapi import Request, Response
 from fps import get_nowait
 from holm import action
 from htmy import Component
 
+from .cache import check_etag, get_version
 from .html import get_environments, get_servers
 from ..hub import Hub
 
 
 @action.get()
-async def servers() -> Component:
-    return get_servers()
+async def servers(request: Request) -> Component | Response:
+    with get_nowait(Hub) as hub:
+        not_modified = check_etag(request, get_version(hub))
+    return not_modified or get_servers()
 
 
 @action.put()
@@ -19,5 +23,7 @@ async def create_server() -> Component:
 
 
 @action.get()
-async def environments() -> Component:
-    return get_environments()
+async def environments(request: Request) -> Component | Response:
+    with get_nowait(Hub) as hub:
+        not_modified = check_etag(request, get_version(hub))
+    return not_modified or get_environments()
@@ -0,0 +1,44 @@
+from collections.abc import AsyncIterator
+
+from anyio import move_on_after
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fps import get_nowait
+
+from ..hub import Hub
+
+
+api = APIRouter()
+
+
+@api.get("/events", include_in_schema=False)
+async def events() -> StreamingResponse:
+    # server-sent events, the page refreshes the parts that changed
+    with get_nowait(Hub) as hub:
+        event_bus = hub.events
+
+    async def stream() -> AsyncIterator[str]:
+        with event_bus.subscribe() as receive_stream:
+            yield "retry: 1000\n\n"
+            while True:
+                event = None
+                with move_on_after(15):
+                    event = await receive_stream.receive()
+                if event is None:
+                    # keep the connection open through proxies
+                    yield ": keepalive\n\n"
+                else:
+                    yield f"data: {event}\n\n"
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@api.get("/metrics", include_in_schema=False)
+async def metrics() -> PlainTextResponse:
+    with get_nowait(Hub) as hub:
+        metrics = await hub.get_metrics()
+    return PlainTextResponse(metrics, media_type="text/plain; version=0.0.4")
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from fastapi import Request, Response
+from htmy import ComponentType, Context, SafeStr
+from htmy.renderer.context import RendererContext
+
+from ..hub import Hub
+
+
+# rendered fragments by key, with the version they were rendered at
+_fragments: OrderedDict[str, tuple[str, str]] = OrderedDict()
+MAX_FRAGMENTS = 10_000
+
+
+@dataclass(frozen=True)
+class CachedFragment:
+    # a part of the page that is only rendered again when its version changes
+    key: str
+    version: str
+    factory: Callable[[], ComponentType]
+
+    async def htmy(self, context: Context) -> ComponentType:
+        cached = _fragments.get(self.key)
+        if cached is not None and cached[0] == self.version:
+            _fragments.move_to_end(self.key)
+            return SafeStr(cached[1])
+
+        renderer = RendererContext.from_context(context)
+        rendered = await renderer.render(self.factory(), context)
+        _fragments[self.key] = (self.version, rendered)
+        _fragments.move_to_end(self.key)
+        if len(_fragments) > MAX_FRAGMENTS:
+            _fragments.popitem(last=False)
+        return SafeStr(rendered)
+
+
+def check_etag(request: Request, version: str) -> Response | None:
+    # the browser revalidates the response, which is not sent again if unchanged
+    etag = f'W/"{version}"'
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=get_etag_headers(etag))
+    # added to the response by the app middleware, in the scope as the server can
+    # share the state between requests
+    request.scope["macroverse.etag"] = etag
+    return None
+
+
+def get_etag_headers(etag: str) -> dict[str, str]:
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+
+def get_version(hub: Hub, event: str | None = None) -> str:
+    # of the whole state, or of an entity
+    version = hub.version if event is None else hub.versions.get(event, 0)
+    return f"{hub.state_id}-{version}"
@@ -0,0 +1,62 @@
+from htmy import ComponentType, html
+
+from ....tracing import Span, tracer
+
+
+metadata = {"title": "Macroverse traces"}
+
+
+def page() -> ComponentType:
+    # the slowest recent operations, with the time spent in each of their phases
+    return html.div(
+        html.h2("Slowest operations"),
+        *[get_trace(root, spans) for root, spans in tracer.get_slowest_traces()],
+    )
+
+
+def get_trace(root: Span, spans: list[Span]) -> ComponentType:
+    children: dict[str | None, list[Span]] = {}
+    for span in sorted(spans, key=lambda span: span.start):
+        children.setdefault(span.parent_id, []).append(span)
+    rows: list[ComponentType] = []
+    stack = [(root, 0)]
+    while stack:
+        span, depth = stack.pop()
+        rows.append(get_span(span, root, depth))
+        stack.extend(
+            (child, depth + 1) for child in reversed(children.get(span.span_id, []))
+        )
+    return html.details(
+        html.summary(f"{root.name} {format_attributes(root)}: {format_duration(root)}"),
+        html.table(
+            html.thead(
+                html.tr(
+                    html.th("Span"),
+                    html.th("Start"),
+                    html.th("Duration"),
+                    html.th("Error"),
+                )
+            ),
+            html.tbody(*rows),
+        ),
+    )
+
+
+def get_span(span: Span, root: Span, depth: int) -> ComponentType:
+    return html.tr(
+        html.td(
+            f"{span.name} {format_attributes(span)}",
+            style=f"padding-left:{depth * 1.5 + 0.5}em",
+        ),
+        html.td(f"+{(span.start - root.start) * 1000:.1f}ms"),
+        html.td(format_duration(span)),
+        html.td(span.error or ""),
+    )
+
+
+def format_attributes(span: Span) -> str:
+    return " ".join(f"{key}={value}" for key, value in span.attributes.items())
+
+
+def format_duration(span: Span) -> str:
+    return f"{(span.duration or 0) * 1000:.1f}ms"
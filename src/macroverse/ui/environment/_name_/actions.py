@@ -1,14 +1,25 @@
+from fastapi import Request, Response
 from fps import get_nowait
 from htmy import Component
 from holm import action
 
 
+from ...cache import check_etag, get_version
 from ...html import get_environment, get_servers_and_environments
 from ....hub import Hub
 
 
 @action.get()
-async def status(name: str) -> Component:
+async def status(name: str, request: Request) -> Component | Response:
+    with get_nowait(Hub) as hub:
+        if name not in hub.containers:
+            # its creation failed or was cancelled
+            return ""
+
+        version = get_version(hub, f"environment-{name}")
+        not_modified = check_etag(request, version)
+        if not_modified is not None:
+            return not_modified
     return get_environment(name)
 
 
@@ -17,3 +28,10 @@ async def delete_environment(name: str) -> Component:
     with get_nowait(Hub) as hub:
         await hub.delete_environment(name)
         return get_servers_and_environments()
+
+
+@action.delete()
+async def cancel(name: str) -> Component:
+    with get_nowait(Hub) as hub:
+        await hub.cancel_environment(name)
+        return get_servers_and_environments()
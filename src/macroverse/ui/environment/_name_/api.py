@@ -0,0 +1,38 @@
+from fastapi import APIRouter, Request, Response
+from fastapi.responses import PlainTextResponse, RedirectResponse
+from fps import get_nowait
+from structlog import get_logger
+
+from ....hub import Hub
+
+
+logger = get_logger()
+api = APIRouter()
+
+
+@api.api_route(
+    "/wake",
+    methods=["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
+    include_in_schema=False,
+)
+async def wake(name: str, request: Request) -> Response:
+    # NGINX sends here the requests for an environment whose server is not running
+    with get_nowait(Hub) as hub:
+        if name not in hub.containers:
+            return PlainTextResponse("Environment not found", status_code=404)
+
+        try:
+            await hub.wake_container_server(name)
+        except Exception as exception:
+            logger.error(
+                f'Could not start server for environment "{name}"',
+                exception=repr(exception),
+            )
+            return PlainTextResponse("Environment server unavailable", status_code=503)
+
+    # retry the original request, now that the server is running; a WebSocket
+    # handshake cannot follow a redirect, so it fails and the client has to reconnect
+    original_uri = request.headers.get("x-original-uri", "")
+    if not original_uri.startswith("/jupyverse/"):
+        original_uri = "/"
+    return RedirectResponse(original_uri, status_code=307)
@@ -11,16 +11,28 @@ from ...hub import Hub
 
 @action.get()
 async def edit() -> Component:
+    return _get_form(DEFAULT_ENVIRONMENT_YAML)
+
+
+def _get_form(
+    environment_yaml: str, priority: int = 0, error: str | None = None
+) -> Component:
     return html.form(
         html.div(
             html.label("Environment YAML"),
             html.textarea(
-                DEFAULT_ENVIRONMENT_YAML,
+                environment_yaml,
                 name="environment_yaml",
                 cols="64",
                 rows="6",
             ),
         ),
+        html.div(
+            # the queued builds run by priority, lowest first
+            html.label("Build priority (lowest first)"),
+            html.input_(type="number", name="priority", value=str(priority)),
+        ),
+        *([] if error is None else [html.p(error)]),
         html.button(
             "Submit",
         ),
@@ -42,9 +54,14 @@ async def new() -> Component:
 
 
 @action.put()
-async def create(environment_yaml: Annotated[str, Form()]) -> Component:
+async def create(
+    environment_yaml: Annotated[str, Form()], priority: Annotated[int, Form()] = 0
+) -> Component:
     with get_nowait(Hub) as hub:
-        await hub.create_environment(environment_yaml)
+        try:
+            await hub.create_environment(environment_yaml, priority)
+        except ValueError as exception:
+            return _get_form(environment_yaml, priority, str(exception))
         return get_environments(), new_environment()
 
 
@@ -1,6 +1,9 @@
+from functools import partial
+
 from fps import get_nowait
 from htmy import ComponentType, html
 
+from .cache import CachedFragment, get_version
 from ..hub import Hub
 
 
@@ -27,6 +30,9 @@ def get_servers() -> ComponentType:
         return html.table(
             html.tbody(*[get_server(uuid) for uuid in hub.servers]),
             id="servers",
+            hx_get="/macroverse/servers",
+            hx_trigger="servers from:body",
+            hx_swap="outerHTML",
         )
 
 
@@ -40,6 +46,14 @@ def add_environment_button(id: str) -> ComponentType:
 
 
 def get_server(uuid: str) -> ComponentType:
+    with get_nowait(Hub) as hub:
+        event = f"server-{uuid}"
+        return CachedFragment(
+            event, get_version(hub, event), partial(_get_server, uuid)
+        )
+
+
+def _get_server(uuid: str) -> ComponentType:
     with get_nowait(Hub) as hub:
         server = hub.servers[uuid]
         elements = [
@@ -68,6 +82,9 @@ def get_server(uuid: str) -> ComponentType:
         return html.tr(
             *elements,
             id=f"server-{server.id}",
+            hx_get=f"/macroverse/server/{server.id}/status",
+            hx_trigger=f"server-{server.id} from:body",
+            hx_swap="outerHTML",
         )
 
 
@@ -106,10 +123,21 @@ def get_environments() -> ComponentType:
         return html.table(
             html.tbody(*elements),
             id="environments",
+            hx_get="/macroverse/environments",
+            hx_trigger="environments from:body",
+            hx_swap="outerHTML",
         )
 
 
 def get_environment(name: str) -> ComponentType:
+    with get_nowait(Hub) as hub:
+        event = f"environment-{name}"
+        return CachedFragment(
+            event, get_version(hub, event), partial(_get_environment, name)
+        )
+
+
+def _get_environment(name: str) -> ComponentType:
     with get_nowait(Hub) as hub:
         container = hub.containers[name]
         elements = [html.td(name)]
@@ -129,6 +157,9 @@ def get_environment(name: str) -> ComponentType:
         return html.tr(
             *elements,
             id=f"environment_{name}",
+            hx_get=f"/macroverse/environment/{name}/status",
+            hx_trigger=f"environment-{name} from:body",
+            hx_swap="outerHTML",
         )
 
 
@@ -147,12 +178,24 @@ def creating_environment(name: str) -> ComponentType:
         if create_time is None:
             return start_server_button(name)
         else:
+            position = hub.build_scheduler.get_position(name)
+            if position:
+                status: ComponentType = f"Queued (position {position})"
+            else:
+                # the page counts the seconds since then, see the layout
+                status = html.span(
+                    "Creating (",
+                    html.span(data_create_time=str(int(create_time * 1000))),
+                    ")",
+                )
             return html.div(
-                f"Creating ({create_time}s)",
-                hx_get=f"/macroverse/environment/{name}/status",
-                hx_trigger="load delay:1s",
-                hx_swap="outerHTML",
-                hx_target=f"#environment_{name}",
+                status,
+                html.button(
+                    "Cancel",
+                    hx_delete=f"/macroverse/environment/{name}/cancel",
+                    hx_swap="outerHTML",
+                    hx_target="#servers-and-environments",
+                ),
             )
 
 
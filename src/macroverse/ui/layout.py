@@ -1,11 +1,17 @@
+from fps import get_nowait
 from htmy import Component, ComponentType, Context, component, html
 
 from holm import Metadata
 
+from ..hub import Hub
+
 
 @component
 def layout(children: ComponentType, context: Context) -> Component:
     metadata = Metadata.from_context(context)
+    with get_nowait(Hub) as hub:
+        # served by NGINX, see assets.py
+        assets = hub.assets
 
     return (
         html.DOCTYPE.html,
@@ -18,9 +24,10 @@ def layout(children: ComponentType, context: Context) -> Component:
                 ),
                 html.link(  # Use PicoCSS to add some default styling.
                     rel="stylesheet",
-                    href="https://cdn.jsdelivr.net/npm/@picocss/pico@2/css/pico.min.css",
+                    href=assets["pico.min.css"],
                 ),
-                html.script(src="https://unpkg.com/htmx.org@4.0.0-alpha6"),
+                html.script(src=assets["htmx.min.js"]),
+                html.script(src=assets["macroverse.js"]),
             ),
             html.body(
                 html.main(children, class_="container"),
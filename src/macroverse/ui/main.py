@@ -1,4 +1,19 @@
+from collections.abc import Callable
+from typing import Any
+
+from fastapi import Request
 from holm import App
 
+from .cache import get_etag_headers
+
 
 macroverse_app = App()
+
+
+@macroverse_app.middleware("http")
+async def add_etag(request: Request, call_next: Callable[[Request], Any]) -> Any:
+    response = await call_next(request)
+    etag = request.scope.get("macroverse.etag")
+    if etag is not None and response.status_code == 200:
+        response.headers.update(get_etag_headers(etag))
+    return response
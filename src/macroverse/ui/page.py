@@ -1,7 +1,13 @@
+from fastapi import Request, Response
+from fps import get_nowait
 from htmy import Component
 
+from .cache import check_etag, get_version
 from .html import get_servers_and_environments
+from ..hub import Hub
 
 
-def page() -> Component:
-    return get_servers_and_environments()
+def page(request: Request) -> Component | Response:
+    with get_nowait(Hub) as hub:
+        not_modified = check_etag(request, get_version(hub))
+    return not_modified or get_servers_and_environments()
@@ -1,14 +1,28 @@
 from typing import Annotated
 
-from fastapi import Form
+from fastapi import Form, Request, Response
 from fps import get_nowait
 from holm import action
 from htmy import Component, html
 
+from ...cache import check_etag, get_version
 from ...html import add_environment_button, get_servers, get_server
 from ....hub import Hub
 
 
+@action.get()
+async def status(id: str, request: Request) -> Component | Response:
+    with get_nowait(Hub) as hub:
+        if id not in hub.servers:
+            # it was deleted, which its version may not tell
+            return ""
+
+        not_modified = check_etag(request, get_version(hub, f"server-{id}"))
+        if not_modified is not None:
+            return not_modified
+    return get_server(id)
+
+
 @action.get()
 async def add_environment(id: str) -> Component:
     return add_environment_button(id)
@@ -47,6 +61,5 @@ async def edit_environments(id: str) -> Component:
 async def environments(id: str, environment_names: Annotated[str, Form()]) -> Component:
     environment_list = environment_names.split()
     with get_nowait(Hub) as hub:
-        for name in environment_list:
-            await hub.add_server_environment(id, name)
+        await hub.add_server_environments(id, environment_list)
         return get_server(id)
@@ -0,0 +1,23 @@
+// the hub pushes the names of what changed, as events that the elements listen to
+let connected = false;
+const events = new EventSource("/macroverse/events");
+events.onopen = () => {
+  if (connected) {
+    // events may have been missed while disconnected
+    document.body.dispatchEvent(new CustomEvent("servers"));
+    document.body.dispatchEvent(new CustomEvent("environments"));
+  }
+  connected = true;
+};
+events.onmessage = (event) => {
+  document.body.dispatchEvent(new CustomEvent(event.data));
+};
+// the server renders the creation times, so that a response can be cached
+const updateElapsed = () => {
+  for (const element of document.querySelectorAll("[data-create-time]")) {
+    const elapsed = (Date.now() - element.dataset.createTime) / 1000;
+    element.textContent = `${Math.max(0, Math.round(elapsed))}s`;
+  }
+};
+document.addEventListener("htmx:load", updateElapsed);
+setInterval(updateElapsed, 1000);
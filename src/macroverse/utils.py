@@ -1,9 +1,17 @@
+import hashlib
+import json
 import re
 import string
+from functools import lru_cache
 from socket import socket
-from typing import Any
+from typing import Any, Literal
 
+import httpx
+from anyio import Path
 
+
+Routing = Literal["prefix", "regex"]
+Transport = Literal["tcp", "host", "unix"]
 _remove_converter_pattern = re.compile(r":\w+}")
 _formatter = string.Formatter()
 
@@ -21,23 +29,173 @@ def get_unused_tcp_ports(number: int) -> list[int]:
             sock.close()
 
 
+def is_tcp_port_free(port: int) -> bool:
+    with socket() as sock:
+        try:
+            sock.bind(("", port))
+        except OSError:
+            return False
+    return True
+
+
+class PortAllocator:
+    # a port is reserved until it is released, so it is never given twice, and the
+    # ports taken by other programs are skipped
+    def __init__(self, first: int, last: int) -> None:
+        self.ports = range(first, last + 1)
+        self.reserved: set[int] = set()
+        self._index = 0
+
+    def reserve(self) -> int:
+        # go around the range, so that a released port is not reused right away
+        for _ in self.ports:
+            port = self.ports[self._index]
+            self._index = (self._index + 1) % len(self.ports)
+            if port not in self.reserved and is_tcp_port_free(port):
+                self.reserved.add(port)
+                return port
+        raise RuntimeError("No free port left")
+
+    def claim(self, port: int) -> None:
+        self.reserved.add(port)
+
+    def release(self, port: int) -> None:
+        self.reserved.discard(port)
+
+
+# the name goes into paths, and into the NGINX configuration
+ENVIRONMENT_NAME = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9_.-]*")
+
+
+def check_environment_name(name: Any) -> None:
+    if not isinstance(name, str) or not ENVIRONMENT_NAME.fullmatch(name):
+        raise ValueError(
+            f"Invalid environment name (letters, digits, _, - and .): {name}"
+        )
+
+
+def hash_environment_definition(definition: dict[str, Any]) -> str:
+    # the name doesn't change what gets installed, and neither does the order of
+    # the dependencies or the spacing in their specs
+    normalized = {key: val for key, val in definition.items() if key != "name"}
+    dependencies = []
+    for dependency in normalized.get("dependencies", []):
+        if isinstance(dependency, dict):
+            dependency = {
+                key: sorted("".join(str(spec).split()) for spec in val)
+                for key, val in dependency.items()
+            }
+        else:
+            dependency = "".join(str(dependency).split())
+        dependencies.append(dependency)
+    normalized["dependencies"] = sorted(
+        dependencies, key=lambda dependency: json.dumps(dependency, sort_keys=True)
+    )
+    normalized_str = json.dumps(normalized, sort_keys=True)
+    return hashlib.sha256(normalized_str.encode()).hexdigest()
+
+
+async def atomic_write_text(path: Path, text: str) -> None:
+    # nginx must never see a partially written file
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    await tmp_path.write_text(text)
+    await tmp_path.replace(path)
+
+
 def process_routes(
-    routes: list[dict[str, Any]], environment_server_port: int, uuid: str
+    routes: list[dict[str, Any]],
+    upstream: str | None,
+    uuid: str,
+    routing: Routing = "regex",
+    fallback: str | None = None,
+) -> str:
+    frozen_routes = tuple((route["path"], tuple(route["methods"])) for route in routes)
+    proxy = get_proxy(upstream, fallback)
+    return _process_routes(frozen_routes, proxy, uuid, routing)
+
+
+def process_prefix(upstream: str | None, uuid: str, fallback: str | None = None) -> str:
+    # everything under the prefix goes to the environment server, no regex needed
+    proxy = get_proxy(upstream, fallback, "/")
+    return NGINX_PREFIX.format(uuid=uuid, proxy=proxy)
+
+
+def process_fallback(fallback: str, env_name: str, macroverse_port: int) -> str:
+    return NGINX_FALLBACK.format(
+        fallback=fallback, env_name=env_name, macroverse_port=macroverse_port
+    )
+
+
+def get_http_client(socket: str | None = None) -> httpx.AsyncClient:
+    # to talk to an environment server, on a TCP port or a unix socket
+    if socket is None:
+        return httpx.AsyncClient()
+    return httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(uds=socket))
+
+
+def get_upstream(port: int | None) -> str | None:
+    # where NGINX proxies the requests of an environment server to, see
+    # process_upstream
+    if port is None:
+        return None
+    return f"environment_server_{port}"
+
+
+def process_upstream(
+    port: int, socket: str | None = None, host: str | None = None, keepalive: int = 0
+) -> str:
+    # an upstream per environment server, whose connections are kept open for reuse
+    address = (
+        f"unix:{socket}" if socket is not None else f"{host or 'localhost'}:{port}"
+    )
+    keepalive_conf = f"    keepalive {keepalive};\n" if keepalive else ""
+    return NGINX_UPSTREAM.format(
+        upstream=get_upstream(port), address=address, keepalive=keepalive_conf
+    )
+
+
+def get_proxy(upstream: str | None, fallback: str | None, uri: str = "") -> str:
+    # without a running server, or if it doesn't answer, the request goes to the
+    # fallback (before any rewrite, which would skip the return)
+    if upstream is None:
+        proxy = "return 503;"
+    else:
+        proxy = f"proxy_pass http://{upstream}{uri};"
+    if fallback is not None:
+        proxy = f"error_page 502 503 = @{fallback};\n        {proxy}"
+    return proxy
+
+
+@lru_cache(maxsize=4096)
+def _process_routes(
+    routes: tuple[tuple[str, tuple[str, ...]], ...],
+    proxy: str,
+    uuid: str,
+    routing: Routing,
 ) -> str:
     http_redirects = {}
     ws_redirects = {}
-    for route in routes:
-        path = _remove_converter_pattern.sub("}", route["path"])
+    for route_path, route_methods in routes:
+        path = _remove_converter_pattern.sub("}", route_path)
         names = [v[1] for v in _formatter.parse(path) if v[1] is not None]
         src = _formatter.vformat(path, [], {name: "(.*)" for name in names})
         dst = _formatter.vformat(
             path, [], {name: f"${i + 1}" for i, name in enumerate(names)}
         )
-        methods = route["methods"]
+        methods = list(route_methods)
         if methods == ["WEBSOCKET"]:
             ws_redirects[src] = (dst, methods)
         else:
             http_redirects[src] = (dst, methods)
+    if routing == "prefix":
+        # a route's destination is always its source without the prefix, so
+        # all the routes can share one location
+        return NGINX_REDIRECT_ENVIRONMENT.format(
+            uuid=uuid,
+            srcs="|".join([*ws_redirects, *http_redirects]),
+            proxy=proxy,
+        )
+
     redirects = []
     for src, val in ws_redirects.items():
         dst, methods = val
@@ -47,7 +205,7 @@ def process_routes(
                 src=src,
                 dst=dst,
                 methods=methods,
-                environment_server_port=environment_server_port,
+                proxy=proxy,
             )
         )
     for src, val in http_redirects.items():
@@ -58,17 +216,59 @@ def process_routes(
                 src=src,
                 dst=dst,
                 methods=methods,
-                environment_server_port=environment_server_port,
+                proxy=proxy,
             )
         )
     return "".join(redirects)
 
 
+NGINX_UPSTREAM = """
+upstream {upstream} {{
+    server {address};
+{keepalive}}}
+"""
+
+
 NGINX_REDIRECT_HTTP = """
     # redirect {methods} {src}
     location ~ ^/jupyverse/{uuid}{src}$ {{
+        proxy_http_version 1.1;
+        proxy_set_header Connection "";
+        {proxy}
         rewrite ^/jupyverse/{uuid}{src} {dst} break;
-        proxy_pass http://localhost:{environment_server_port};
+    }}
+"""
+
+
+NGINX_REDIRECT_ENVIRONMENT = """
+    # redirect routes of environment server
+    location ~ ^/jupyverse/{uuid}(?:{srcs})$ {{
+        proxy_http_version 1.1;
+        proxy_set_header Upgrade $http_upgrade;
+        proxy_set_header Connection $connection_upgrade;
+        {proxy}
+        rewrite ^/jupyverse/{uuid}(/.*)$ $1 break;
+    }}
+"""
+
+
+NGINX_PREFIX = """
+    # environment server
+    location /jupyverse/{uuid}/ {{
+        proxy_http_version 1.1;
+        proxy_set_header Upgrade $http_upgrade;
+        proxy_set_header Connection $connection_upgrade;
+        {proxy}
+    }}
+"""
+
+
+NGINX_FALLBACK = """
+    # start the server of environment "{env_name}" on request
+    location @{fallback} {{
+        rewrite ^ /macroverse/environment/{env_name}/wake break;
+        proxy_set_header X-Original-URI $request_uri;
+        proxy_pass http://localhost:{macroverse_port};
     }}
 """
 
@@ -79,7 +279,7 @@ NGINX_REDIRECT_WS = """
         proxy_http_version 1.1;
         proxy_set_header Upgrade $http_upgrade;
         proxy_set_header Connection $connection_upgrade;
+        {proxy}
         rewrite ^/jupyverse/{uuid}{src} {dst} break;
-        proxy_pass http://localhost:{environment_server_port};
     }}
 """